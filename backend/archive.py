@@ -0,0 +1,119 @@
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from dotenv import load_dotenv
+from serialization import dumps_bytes, loads
+import asyncio
+import gzip
+import os
+import models
+
+load_dotenv()
+
+# Messages older than a chat's retention (group_chat.retention_days, or
+# MESSAGE_RETENTION_DAYS when that is unset) move out of the hot table into
+# gzipped newline-delimited JSON, one file per chat per month:
+#
+#     ARCHIVE_DIR/chat_<id>/<YYYY-MM>.ndjson.gz
+#
+# Each run appends a new gzip member, so a file can be read back as one
+# stream. Rows are written and fsynced before they are deleted. A crash
+# between those steps can leave a row in both places; readers dedupe by id.
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", str(Path(__file__).resolve().parent / "archive")))
+MESSAGE_RETENTION_DAYS = os.getenv("MESSAGE_RETENTION_DAYS")
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+# Seconds between archiver runs inside the app (0 = only via `python archive.py`).
+# Every host must see the same ARCHIVE_DIR, since any worker can read it.
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "0"))
+
+
+def chat_dir(chat_id: int) -> Path:
+    return ARCHIVE_DIR / f"chat_{chat_id}"
+
+
+def archive_row(m: models.Messages):
+    return {
+        "id" : m.id,
+        "account_id" : m.account_id if m.account_id is not None else 0,
+        "chat_id" : m.chat_id,
+        "text" : m.text,
+        "created_at" : m.created_at.isoformat(),
+        "author_username" : m.author_username,
+        "seq" : m.seq
+    }
+
+
+def _append(chat_id: int, rows):
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row["created_at"][:7], []).append(row)
+    directory = chat_dir(chat_id)
+    directory.mkdir(parents=True, exist_ok=True)
+    for month, month_rows in by_month.items():
+        with open(directory / f"{month}.ndjson.gz", "ab") as f:
+            f.write(gzip.compress(b"".join(dumps_bytes(r) + b"\n" for r in month_rows)))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+async def archive_chat(db: AsyncSession, chat: models.Chats, cutoff: datetime) -> int:
+    moved = 0
+    while True:
+        rows = (await db.scalars(select(models.Messages)
+                .where(models.Messages.chat_id == chat.id, models.Messages.created_at < cutoff)
+                .order_by(models.Messages.created_at, models.Messages.id)
+                .limit(ARCHIVE_BATCH_SIZE))).all()
+        if not rows:
+            return moved
+        await asyncio.to_thread(_append, chat.id, [archive_row(m) for m in rows])
+        await db.execute(delete(models.Messages).where(models.Messages.id.in_([m.id for m in rows])))
+        chat.archived_until = max(chat.archived_until or rows[-1].created_at, rows[-1].created_at)
+        await db.commit()
+        moved += len(rows)
+
+
+async def run_archiver(session_factory) -> int:
+    # One pass over every chat that has a retention period. Returns rows moved.
+    default_days = int(MESSAGE_RETENTION_DAYS) if MESSAGE_RETENTION_DAYS else None
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    moved = 0
+    async with session_factory() as db:
+        days = func.coalesce(models.Chats.retention_days, default_days)
+        chats = (await db.execute(select(models.Chats, days).where(days.is_not(None)))).all()
+        for chat, retention_days in chats:
+            moved += await archive_chat(db, chat, now - timedelta(days=retention_days))
+    return moved
+
+
+def _read(chat_id: int, before=None, after=None, limit: int = 50):
+    # Rows strictly between the (created_at, id) keys, newest `limit` of them
+    # when paging back, oldest `limit` when walking forward. Ascending order.
+    directory = chat_dir(chat_id)
+    if not directory.exists():
+        return []
+    files = sorted(directory.glob("*.ndjson.gz"), reverse=after is None)
+    found = {}
+    for path in files:
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                row = loads(line)
+                key = (datetime.fromisoformat(row["created_at"]), row["id"])
+                if (before is None or key < before) and (after is None or key > after):
+                    found[row["id"]] = (key, row)
+        # Files are per month, so once a file fills the page the older (or
+        # newer) months can't contribute anything that ranks ahead of it
+        if len(found) >= limit:
+            break
+    ordered = sorted(found.values(), key=lambda item: item[0])
+    ordered = ordered[:limit] if after is not None else ordered[-limit:]
+    return [row for _, row in ordered]
+
+
+async def read_archive(chat_id: int, before=None, after=None, limit: int = 50):
+    return await asyncio.to_thread(_read, chat_id, before, after, limit)
+
+
+if __name__ == "__main__":
+    from database import AsyncSessionLocal
+    print(f"Archived {asyncio.run(run_archiver(AsyncSessionLocal))} messages")
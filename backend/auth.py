@@ -3,12 +3,12 @@ from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from datetime import datetime, timedelta, timezone
 from jose import jwt, JWTError
-from passlib.context import CryptContext
 from dotenv import load_dotenv
-from database import get_db
+from database import get_async_db
 from typing import Annotated
-from sqlalchemy.orm import Session
-import models
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import models, cache, hashing
 import os
 
 load_dotenv()
@@ -24,73 +24,96 @@ JWT_SECRET = os.getenv("JWT_SECRET")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = hashing.pwd_context
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def get_user_by_id(db: Session, user_id: int):
-    return db.query(models.Accounts).filter(models.Accounts.id == user_id).first()
+async def get_user_by_id(db: AsyncSession, user_id: int):
+    return await db.get(models.Accounts, user_id)
 
-def get_user_by_username(db: Session, username: str,):
-    return db.query(models.Accounts).filter(models.Accounts.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str,):
+    return await db.scalar(select(models.Accounts).where(models.Accounts.username == username))
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await hashing.hash_password(password)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await hashing.verify_password(plain_password, hashed_password)
 
-def get_user_from_token(token: str, db: Session):
-    credential_exception = HTTPException(
+# Opt-in stateless mode: trust the id/username claims in the token instead of
+# loading the account row on every request. Logging out bumps
+# Accounts.token_version, which tokens carry as "ver" and which is checked
+# against a short-lived, broker-invalidated cache.
+AUTH_STATELESS = os.getenv("AUTH_STATELESS", "0") == "1"
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+TOKEN_VERSION_TTL = float(os.getenv("TOKEN_VERSION_TTL", "30"))
+
+class Principal(BaseModel):
+    id: int
+    username: str
+    email: str | None = None
+
+decoded_tokens = cache.TTLCache(maxsize=100000, ttl=TOKEN_CACHE_TTL)
+token_versions = cache.SharedTTLCache("token_version_invalidate", maxsize=100000, ttl=TOKEN_VERSION_TTL)
+
+def credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
-        sub = payload.get("sub")
-        if sub is None:
-            raise credential_exception
-        user_id = int(sub)
-    except (JWTError, ValueError):
-        raise credential_exception
-
-    user = get_user_by_id(db=db, user_id=user_id)
-    if user is None:
-        raise credential_exception
-    return user
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credential_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
-                            detail="Could not validate credentials", 
-                            headers={"WWW-Authenticate" : "Bearer"})
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
-        sub = payload.get("sub")
-        if sub is None:
-            raise credential_exception
-        user_id = int(sub)
-        token_data = TokenData(user_id=user_id)
-
-    except (JWTError, ValueError):
-        raise credential_exception
-    
-    user = get_user_by_id(db=db, user_id=token_data.user_id)
-    if user is None:
-        raise credential_exception
-    
+def decode_token(token: str):
+    payload = decoded_tokens.get(token)
+    if payload is cache.MISSING:
+        try:
+            payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
+            TokenData(user_id=int(payload["sub"]))
+        except (JWTError, ValueError, KeyError, TypeError):
+            raise credentials_exception()
+        decoded_tokens.set(token, payload)
+    elif payload["exp"] <= datetime.now(timezone.utc).timestamp():
+        decoded_tokens.pop(token)
+        raise credentials_exception()
+    return payload
+
+async def get_token_version(db: AsyncSession, user_id: int):
+    version = token_versions.get(user_id)
+    if version is cache.MISSING:
+        version = await db.scalar(select(models.Accounts.token_version).where(models.Accounts.id == user_id))
+        token_versions.set(user_id, version)
+    return version
+
+async def get_user_from_token(token: str, db: AsyncSession, stateless: bool = AUTH_STATELESS):
+    payload = decode_token(token)
+    user_id = int(payload["sub"])
+
+    # Tokens issued before the claims existed fall through to the full lookup
+    if stateless and "username" in payload and "ver" in payload:
+        if await get_token_version(db, user_id) != payload["ver"]:
+            raise credentials_exception()
+        return Principal(id=user_id, username=payload["username"])
+
+    user = await get_user_by_id(db=db, user_id=user_id)
+    if user is None or payload.get("ver", user.token_version) != user.token_version:
+        raise credentials_exception()
     return user
 
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    return await get_user_from_token(token, db)
+
+async def get_current_account(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    return await get_user_from_token(token, db, stateless=False)
 
 
 async def get_current_active_user(current_user: models.Accounts = Depends(get_current_user)):
     return current_user
 
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = get_user_by_username(db, username)
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user_by_username(db, username)
     if not user:
         return None
-    if not verify_password(password, user.password):
+    if not await verify_password(password, user.password):
         return None
     return user
 
@@ -0,0 +1,289 @@
+"""End-to-end load test for the chat backend.
+
+Starts uvicorn against a throwaway SQLite database (or --database-url),
+seeds users, chats and history, opens WebSocket clients in every room and
+sends messages at a fixed rate. It reports throughput, HTTP and delivery
+latency (from POST to socket receive), and server CPU time and peak RSS, as
+JSON so runs can be compared across commits.
+
+    cd backend
+    python bench/loadtest.py --rooms 4 --members 10 --sockets 25 --rate 200 --duration 20 -o result.json
+
+With --workers above 1 the workers have to share a database and a broker
+to see each other's messages, so --database-url must point at Postgres; the
+server then runs with BROKER=postgres.
+
+Needs httpx and websockets (the "bench" extra in pyproject.toml).
+"""
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+import websockets
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summary(values):
+    return {
+        "count": len(values),
+        "p50_ms": None if not values else round(percentile(values, 50) * 1000, 3),
+        "p99_ms": None if not values else round(percentile(values, 99) * 1000, 3),
+        "max_ms": None if not values else round(max(values) * 1000, 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def server_env(args, workdir):
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": args.database_url or f"sqlite:///{workdir / 'bench.db'}",
+        "JWT_SECRET": env.get("JWT_SECRET") or "bench-secret",
+        "ALGORITHM": env.get("ALGORITHM") or "HS256",
+        # Seeding logs in every user; the default cost would dominate setup time
+        "BCRYPT_ROUNDS": str(args.bcrypt_rounds),
+    })
+    # Measure the send path, not the rate limiter, unless the caller set limits
+    for name in ("MESSAGE", "CHAT_MESSAGE", "INVITE", "TOKEN"):
+        env.setdefault(f"RATE_LIMIT_{name}", "off")
+    # Sockets are spread over only --members accounts
+    env.setdefault("WS_MAX_SOCKETS_PER_USER", "0")
+    if args.workers > 1:
+        # The in-process broker would keep each worker's rooms to itself
+        env["BROKER"] = "postgres"
+    return env
+
+
+async def migrate_database(env):
+    # In this process rather than a child, so getrusage(RUSAGE_CHILDREN)
+    # measures only the server
+    os.environ.update(env)
+    sys.path.insert(0, str(BACKEND_DIR))
+    import database
+    import migrate
+    await migrate.migrate(database.async_engine)
+    await database.async_engine.dispose()
+
+
+def start_server(args, port, env):
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+           "--workers", str(args.workers), "--log-level", "warning",
+           "--ws-per-message-deflate", "true" if args.deflate else "false"]
+    return subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env)
+
+
+async def wait_ready(base, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/metrics")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+async def seed(client, args):
+    run = uuid.uuid4().hex[:8]
+    users = []
+    for i in range(args.members):
+        name = f"b{run}{i}"
+        r = await client.post("/sign_up", json={"username": name, "email": f"{name}@bench", "password": "pw"})
+        r.raise_for_status()
+        r = await client.post("/token", data={"username": name, "password": "pw"})
+        r.raise_for_status()
+        token = r.json()["access_token"]
+        me = (await client.get("/users/me/", headers={"Authorization": f"Bearer {token}"})).json()
+        users.append({"id": me["user_id"], "token": token})
+
+    owner = {"Authorization": f"Bearer {users[0]['token']}"}
+    chats = []
+    for i in range(args.rooms):
+        r = await client.post("/gc", json={"name": f"bench-{run}-{i}"}, headers=owner)
+        r.raise_for_status()
+        chat_id = r.json()["id"]
+        for user in users[1:]:
+            r = await client.post("/gc/invites", json={"receiver_id": user["id"], "chat_id": chat_id, "text": "bench"},
+                                  headers=owner)
+            r.raise_for_status()
+            r = await client.post(f"/invites/{r.json()['id']}/accept",
+                                  headers={"Authorization": f"Bearer {user['token']}"})
+            r.raise_for_status()
+        for n in range(args.history):
+            await client.post(f"/gc/{chat_id}/messages", json={"text": f"history {n}"}, headers=owner)
+        chats.append(chat_id)
+    return users, chats
+
+
+async def receiver(ws, sent, delivery, received_bytes, stop):
+    try:
+        while not stop.is_set():
+            raw = await ws.recv()
+            now = time.perf_counter()
+            # Payload size before permessage-deflate; the wire may be smaller
+            received_bytes[0] += len(raw) if isinstance(raw, bytes) else len(raw.encode())
+            frame = msgpack.unpackb(raw) if isinstance(raw, bytes) else json.loads(raw)
+            if frame.get("type") == "ping":
+                await ws.send('{"type": "pong"}')
+            elif frame.get("type") == "message":
+                started = sent.get(frame["payload"]["text"])
+                if started is not None:
+                    delivery.append(now - started)
+    except (websockets.ConnectionClosed, asyncio.CancelledError):
+        pass
+
+
+async def run(args):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    ws_base = f"ws://127.0.0.1:{port}"
+    workdir = Path(tempfile.mkdtemp(prefix="chat-bench-"))
+    env = server_env(args, workdir)
+    await migrate_database(env)
+    server = start_server(args, port, env)
+    try:
+        await wait_ready(base)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base, limits=limits, timeout=30) as client:
+            seed_start = time.perf_counter()
+            users, chats = await seed(client, args)
+            seed_seconds = time.perf_counter() - seed_start
+
+            sent, delivery, http_latency, errors, received_bytes = {}, [], [], 0, [0]
+            stop = asyncio.Event()
+            sockets, readers = [], []
+            for chat_id in chats:
+                for i in range(args.sockets):
+                    user = users[i % len(users)]
+                    ws = await websockets.connect(
+                        f"{ws_base}/gc/{chat_id}/ws?token={user['token']}&encoding={args.encoding}",
+                        max_queue=None, compression="deflate" if args.deflate else None)
+                    sockets.append(ws)
+                    readers.append(asyncio.create_task(receiver(ws, sent, delivery, received_bytes, stop)))
+
+            async def send_one(chat_id, user):
+                nonlocal errors
+                text = f"bench {uuid.uuid4().hex}"
+                started = time.perf_counter()
+                sent[text] = started
+                try:
+                    r = await client.post(f"/gc/{chat_id}/messages", json={"text": text},
+                                          headers={"Authorization": f"Bearer {user['token']}"})
+                    if r.status_code != 200:
+                        errors += 1
+                    http_latency.append(time.perf_counter() - started)
+                except httpx.HTTPError:
+                    errors += 1
+
+            # Open-loop sender: messages go out on schedule even if the server lags
+            interval = 1 / args.rate
+            tasks = []
+            run_start = time.perf_counter()
+            next_at = run_start
+            while time.perf_counter() - run_start < args.duration:
+                tasks.append(asyncio.create_task(send_one(random.choice(chats), random.choice(users))))
+                next_at += interval
+                await asyncio.sleep(max(0, next_at - time.perf_counter()))
+            await asyncio.gather(*tasks)
+            send_seconds = time.perf_counter() - run_start
+            await asyncio.sleep(args.drain)
+            stop.set()
+            for ws in sockets:
+                await ws.close()
+            for task in readers:
+                task.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    expected = len(sent) * args.sockets
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "seed_seconds": round(seed_seconds, 3),
+        "messages_sent": len(sent),
+        "send_errors": errors,
+        "send_rate_per_s": round(len(sent) / send_seconds, 1),
+        "deliveries": len(delivery),
+        "deliveries_expected": expected,
+        "delivery_rate_per_s": round(len(delivery) / send_seconds, 1),
+        "http_latency": summary(http_latency),
+        "delivery_latency": summary(delivery),
+        "received_payload_bytes": received_bytes[0],
+        "server_cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        "server_max_rss_mb": round(usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=2)
+    parser.add_argument("--members", type=int, default=5, help="accounts, all members of every room")
+    parser.add_argument("--sockets", type=int, default=10, help="WebSocket clients per room")
+    parser.add_argument("--history", type=int, default=50, help="messages seeded per room")
+    parser.add_argument("--rate", type=float, default=50, help="messages per second across all rooms")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send for")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for deliveries after sending")
+    parser.add_argument("--concurrency", type=int, default=100, help="max HTTP connections")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--encoding", choices=("json", "msgpack"), default="json")
+    parser.add_argument("--deflate", action=argparse.BooleanOptionalAction, default=True,
+                        help="negotiate permessage-deflate")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4)
+    parser.add_argument("--database-url", help="defaults to a fresh SQLite file")
+    parser.add_argument("-o", "--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+    if args.workers > 1 and not (args.database_url or "").startswith("postgresql"):
+        parser.error("--workers above 1 needs a Postgres --database-url for the shared broker")
+
+    result = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        Path(args.output).write_text(result + "\n")
+    else:
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import metrics
+import os
+import threading
+from collections import defaultdict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "memory" keeps fan-out inside this process, "postgres" uses LISTEN/NOTIFY so
+# every worker (and every host) pointed at the same database sees each publish.
+BROKER = os.getenv("BROKER", "memory")
+BROKER_URL = os.getenv("BROKER_URL") or os.getenv("DATABASE_URL")
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_MAX_BYTES = 7999
+BROKER_RECONNECT_MAX = float(os.getenv("BROKER_RECONNECT_MAX", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessBroker:
+    def __init__(self):
+        self.handlers = defaultdict(set)
+
+    async def subscribe(self, channel: str, handler):
+        self.handlers[channel].add(handler)
+
+    async def unsubscribe(self, channel: str, handler):
+        self.handlers[channel].discard(handler)
+        if not self.handlers[channel]:
+            del self.handlers[channel]
+
+    async def publish(self, channel: str, payload: str):
+        for handler in list(self.handlers.get(channel, ())):
+            await handler(payload)
+
+    async def close(self):
+        self.handlers.clear()
+
+
+class PostgresBroker:
+    # One autocommit connection does the LISTENing and is polled from the event
+    # loop with add_reader, so no thread is parked waiting for notifications.
+    # Connecting and (UN)LISTEN run in a thread so they never block the loop.
+    # If the listen connection drops it is reopened with backoff and every
+    # channel LISTENed again; notifications sent meanwhile are lost, which
+    # clients recover from by resuming with ?since_seq=. Publishing uses a
+    # second connection in a worker thread.
+    def __init__(self, url: str):
+        self.url = url
+        self.handlers = defaultdict(set)
+        self.listen_conn = None
+        self.listen_lock = asyncio.Lock()
+        self.reconnecting = None
+        self.publish_conn = None
+        self.publish_lock = threading.Lock()
+        self.loop = None
+
+    def _connect(self):
+        import psycopg2
+        import psycopg2.extensions
+        from sqlalchemy.engine import make_url
+
+        # Accept SQLAlchemy style URLs such as postgresql+psycopg2://...
+        dsn = make_url(self.url).set(drivername="postgresql").render_as_string(hide_password=False)
+        conn = psycopg2.connect(dsn)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    @staticmethod
+    def _execute(conn, statement: str):
+        with conn.cursor() as cur:
+            cur.execute(statement)
+
+    async def _open_listener(self):
+        # Returns with listen_conn LISTENing on every channel in self.handlers
+        async with self.listen_lock:
+            if self.listen_conn is not None:
+                return
+            self.loop = asyncio.get_running_loop()
+            conn = await asyncio.to_thread(self._connect)
+            # subscribe() can add channels while these LISTENs run, and then
+            # waits on the lock for this connection; go round until none are
+            # missing so the connection is only handed over once it has them all
+            listening = set()
+            while missing := set(self.handlers) - listening:
+                for channel in missing:
+                    await asyncio.to_thread(self._execute, conn, f'LISTEN "{channel}"')
+                    listening.add(channel)
+            self.listen_conn = conn
+            self.loop.add_reader(conn.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        try:
+            self.listen_conn.poll()
+        except Exception:
+            logger.exception("Broker listen connection failed, reconnecting")
+            metrics.broker_errors.inc(1, "listen")
+            self._drop_listener()
+            if self.reconnecting is None:
+                self.reconnecting = self.loop.create_task(self._reconnect())
+            return
+        while self.listen_conn.notifies:
+            note = self.listen_conn.notifies.pop(0)
+            for handler in list(self.handlers.get(note.channel, ())):
+                self.loop.create_task(handler(note.payload))
+
+    def _drop_listener(self):
+        conn, self.listen_conn = self.listen_conn, None
+        if conn is not None:
+            self.loop.remove_reader(conn.fileno())
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    async def _reconnect(self):
+        delay = 0.5
+        try:
+            while self.listen_conn is None:
+                try:
+                    await self._open_listener()
+                    logger.warning("Broker listen connection restored")
+                except Exception:
+                    logger.exception("Broker reconnect failed, retrying in %.1fs", delay)
+                    self._drop_listener()
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, BROKER_RECONNECT_MAX)
+        finally:
+            self.reconnecting = None
+
+    async def subscribe(self, channel: str, handler):
+        first = channel not in self.handlers
+        self.handlers[channel].add(handler)
+        if self.listen_conn is None:
+            # Opening the connection LISTENs on every channel, this one included
+            await self._open_listener()
+        elif first:
+            await asyncio.to_thread(self._execute, self.listen_conn, f'LISTEN "{channel}"')
+
+    async def unsubscribe(self, channel: str, handler):
+        self.handlers[channel].discard(handler)
+        if self.handlers[channel]:
+            return
+        del self.handlers[channel]
+        if self.listen_conn is not None:
+            await asyncio.to_thread(self._execute, self.listen_conn, f'UNLISTEN "{channel}"')
+
+    def _notify(self, channel: str, payload: str):
+        with self.publish_lock:
+            if self.publish_conn is None or self.publish_conn.closed:
+                self.publish_conn = self._connect()
+            with self.publish_conn.cursor() as cur:
+                cur.execute("SELECT pg_notify(%s, %s)", (channel, payload))
+
+    async def publish(self, channel: str, payload: str):
+        if len(payload.encode()) > NOTIFY_MAX_BYTES:
+            raise ValueError(f"Broker payload for {channel} is over {NOTIFY_MAX_BYTES} bytes")
+        await asyncio.to_thread(self._notify, channel, payload)
+
+    async def close(self):
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+        self._drop_listener()
+        with self.publish_lock:
+            if self.publish_conn is not None:
+                self.publish_conn.close()
+                self.publish_conn = None
+        self.handlers.clear()
+
+
+def get_broker():
+    if BROKER == "memory":
+        return InProcessBroker()
+    if BROKER == "postgres":
+        return PostgresBroker(BROKER_URL)
+    raise ValueError(f"Unknown BROKER {BROKER!r}, expected 'memory' or 'postgres'")
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from sqlalchemy.ext.asyncio import AsyncSession
+from serialization import dumps, loads
+import models
+import os
+import time
+import uuid
+
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "100000"))
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "60"))
+READ_YOUR_WRITES_TTL = float(os.getenv("READ_YOUR_WRITES_TTL", "5"))
+
+MISSING = object()
+
+
+class TTLCache:
+    # LRU ordered dict where every entry also expires after ttl seconds.
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return MISSING
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value):
+        self.data[key] = (value, time.monotonic() + self.ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def purge(self) -> int:
+        # Drop expired entries that nobody has asked for since; returns how many
+        now = time.monotonic()
+        expired = [key for key, (_, expires) in self.data.items() if expires < now]
+        for key in expired:
+            del self.data[key]
+        return len(expired)
+
+    def stats(self):
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
+
+
+class SharedTTLCache(TTLCache):
+    # A TTLCache whose invalidations are published on the broker so every
+    # worker drops its copy of the key, not just the one that made the write.
+    def __init__(self, channel: str, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self.channel = channel
+        self.broker = None
+        self.origin = uuid.uuid4().hex
+
+    async def start(self, broker):
+        self.broker = broker
+        await broker.subscribe(self.channel, self._on_invalidate)
+
+    async def _on_invalidate(self, payload: str):
+        origin, key = loads(payload)
+        if origin != self.origin:
+            self.pop(tuple(key) if isinstance(key, list) else key)
+
+    async def invalidate(self, key, value=MISSING):
+        if value is MISSING:
+            self.pop(key)
+        else:
+            self.set(key, value)
+        if self.broker is not None:
+            await self.broker.publish(self.channel, dumps([self.origin, key]))
+
+
+class MembershipCache(SharedTTLCache):
+    # (account_id, chat_id) -> bool
+    def __init__(self, maxsize: int = MEMBERSHIP_CACHE_SIZE, ttl: float = MEMBERSHIP_CACHE_TTL):
+        super().__init__("membership_invalidate", maxsize, ttl)
+
+    async def is_member(self, db: AsyncSession, account_id: int, chat_id: int) -> bool:
+        cached = self.get((account_id, chat_id))
+        if cached is not MISSING:
+            return cached
+        return await self._load(db, account_id, chat_id)
+
+    async def is_member_on_primary(self, session_factory, account_id: int, chat_id: int) -> bool:
+        # For routes whose own session may be a replica: write routes trust
+        # this cache, so a miss is looked up on a short primary session rather
+        # than caching what a lagging replica says
+        cached = self.get((account_id, chat_id))
+        if cached is not MISSING:
+            return cached
+        async with session_factory() as db:
+            return await self._load(db, account_id, chat_id)
+
+    async def _load(self, db: AsyncSession, account_id: int, chat_id: int) -> bool:
+        found = await db.get(models.ChatMembers, (account_id, chat_id)) is not None
+        self.set((account_id, chat_id), found)
+        return found
+
+
+class RecentWrites(SharedTTLCache):
+    # account_id -> when this worker last announced that account's write.
+    # Reads by an account in here go to the primary. Other workers mark the
+    # account when they hear about it; announcing at most every ttl/2 keeps
+    # broker traffic to a trickle for busy senders.
+    def __init__(self, maxsize: int = 100000, ttl: float = READ_YOUR_WRITES_TTL):
+        super().__init__("recent_writes", maxsize, ttl)
+
+    async def _on_invalidate(self, payload: str):
+        origin, key = loads(payload)
+        if origin != self.origin:
+            self.set(key, time.monotonic())
+
+    async def mark(self, account_id: int):
+        announced = self.get(account_id)
+        if announced is MISSING or time.monotonic() - announced > self.ttl / 2:
+            await self.invalidate(account_id, time.monotonic())
+        else:
+            self.set(account_id, announced)
+
+    def recent(self, account_id: int) -> bool:
+        return self.get(account_id) is not MISSING
@@ -1,21 +1,63 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from dotenv import load_dotenv
+import asyncio
 import os
 
 load_dotenv()  # loads variables from .env
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+# Async path used by the routes: asyncpg for Postgres, aiosqlite for local SQLite.
+def to_async_url(url: str):
+    u = make_url(url)
+    if u.get_backend_name() == "postgresql":
+        return u.set(drivername="postgresql+asyncpg")
+    if u.get_backend_name() == "sqlite":
+        return u.set(drivername="sqlite+aiosqlite")
+    return u
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", "4"))
+# Create/upgrade the schema at startup instead of with `python migrate.py`.
+# Only for a single worker: several workers would race each other.
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "0") == "1"
+
+def pool_options(url):
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+    # SQLite drivers don't take queue pool sizing
+    if make_url(url).get_backend_name() != "sqlite":
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+    return options
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options(ASYNC_DATABASE_URL))
+
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Engines don't connect until first used. Opening a few connections during
+# startup moves that cost out of the first requests a new worker serves.
+async def warm_pool(engine, size: int = DB_POOL_WARMUP):
+    if size <= 0:
+        return
+    conns = await asyncio.gather(*(engine.connect() for _ in range(min(size, DB_POOL_SIZE))))
+    for conn in conns:
+        await conn.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+# Optional read replica for history and listing routes. Left unset, those
+# routes use the primary. Stickiness after writes is handled in main.py.
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+ASYNC_DATABASE_READ_URL = os.getenv("ASYNC_DATABASE_READ_URL") or (to_async_url(DATABASE_READ_URL) if DATABASE_READ_URL else None)
+
+read_engine = create_async_engine(ASYNC_DATABASE_READ_URL, **pool_options(ASYNC_DATABASE_READ_URL)) if ASYNC_DATABASE_READ_URL else None
+
+AsyncReadSessionLocal = async_sessionmaker(read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False) if read_engine else None
@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from dotenv import load_dotenv
+import asyncio
+import metrics
+import os
+import time
+
+load_dotenv()
+
+# bcrypt is deliberately slow, so it runs on a small dedicated pool instead of
+# the event loop. When more than HASH_MAX_PENDING calls are waiting we shed
+# load with a 503 rather than queueing logins without bound.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "64"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+
+pending = 0
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        metrics.hash_seconds.observe(time.perf_counter() - start, fn.__name__)
+
+
+async def _run(fn, *args):
+    global pending
+    if pending >= HASH_MAX_PENDING:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Server busy, try again shortly.",
+                            headers={"Retry-After": "1"})
+    pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, _timed, fn, *args)
+    finally:
+        pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _run(pwd_context.hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run(pwd_context.verify, plain_password, hashed_password)
+
+
+async def warm_up():
+    # passlib loads and self-tests the bcrypt backend on first use; do it at
+    # startup rather than inside the first login
+    await asyncio.get_running_loop().run_in_executor(executor, pwd_context.handler().get_backend)
+
+
+def shutdown():
+    executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,192 @@
+from fastapi import HTTPException, status
+from sqlalchemy import select, insert, update, case, func, text as sql_text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+import asyncio
+import logging
+import metrics
+import models
+import os
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# MESSAGE_INGEST=batch turns on write-behind persistence. Messages get their id,
+# seq and created_at up front, are broadcast straight away and reach the
+# message table in multi-row INSERTs every INGEST_FLUSH_INTERVAL seconds or
+# INGEST_BATCH_SIZE rows, whichever comes first.
+#
+# Durability: a message acknowledged to the client is only in memory until
+# its batch commits, so a crash can lose up to one flush window. A failed
+# flush is retried with backoff (up to INGEST_RETRY_MAX seconds apart) for as
+# long as it takes, so a database outage only stalls ingest; rows that can
+# never be written, such as one whose chat was deleted, are dropped and
+# counted. Shutdown drains the queue, giving up after INGEST_DRAIN_TIMEOUT.
+# When the queue is full, sends are refused with a 503.
+#
+# Ids come from the Postgres sequence in blocks. Other databases start
+# counting from MAX(id), and per-chat seqs are counted in process from
+# group_chat.last_seq. Batch mode therefore expects every write to a chat
+# to go through one worker: a single worker, or routing that keeps each
+# chat on the same worker.
+MESSAGE_INGEST = os.getenv("MESSAGE_INGEST", "sync")
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "0.05"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_ID_BLOCK = int(os.getenv("INGEST_ID_BLOCK", "1000"))
+INGEST_RETRY_MAX = float(os.getenv("INGEST_RETRY_MAX", "5"))
+INGEST_DRAIN_TIMEOUT = float(os.getenv("INGEST_DRAIN_TIMEOUT", "10"))
+
+
+class MessageBatcher:
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self.lock = asyncio.Lock()
+        self.ids = iter(())
+        self.seqs = {}
+        self.task = None
+        self.current = None
+        self.pending = []
+        self.accepting = False
+        self.give_up_at = None
+
+    def start(self):
+        self.accepting = True
+        self.task = asyncio.create_task(self._run())
+
+    async def _next_id(self, db: AsyncSession):
+        nxt = next(self.ids, None)
+        if nxt is not None:
+            return nxt
+        if db.bind.dialect.name == "postgresql":
+            block = (await db.scalars(
+                sql_text("SELECT nextval(pg_get_serial_sequence('message', 'id')) FROM generate_series(1, :n)"),
+                {"n": INGEST_ID_BLOCK})).all()
+            self.ids = iter(block)
+        else:
+            start = (await db.scalar(select(func.max(models.Messages.id)))) or 0
+            self.ids = iter(range(start + 1, start + 1 + 2**31))
+        return next(self.ids)
+
+    async def _next_seq(self, db: AsyncSession, chat_id: int):
+        if chat_id not in self.seqs:
+            self.seqs[chat_id] = await db.scalar(select(models.Chats.last_seq).where(models.Chats.id == chat_id)) or 0
+        self.seqs[chat_id] += 1
+        return self.seqs[chat_id]
+
+    async def submit(self, db: AsyncSession, chat_id: int, current_user, text: str):
+        if not self.accepting or self.queue.full():
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Server busy, try again shortly.",
+                                headers={"Retry-After": "1"})
+        async with self.lock:
+            m = models.Messages(
+                id = await self._next_id(db),
+                account_id = current_user.id,
+                chat_id = chat_id,
+                text = text,
+                author_username = current_user.username,
+                seq = await self._next_seq(db, chat_id),
+                created_at = datetime.now(timezone.utc).replace(tzinfo=None)
+            )
+            self.queue.put_nowait(m)
+        return m
+
+    async def _run(self):
+        while True:
+            self.pending = [await self.queue.get()]
+            deadline = asyncio.get_running_loop().time() + INGEST_FLUSH_INTERVAL
+            while len(self.pending) < INGEST_BATCH_SIZE:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    self.pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch, self.pending = self.pending, []
+            # Shielded so that drain() can stop the loop without cutting a flush short
+            self.current = asyncio.create_task(self.flush(batch))
+            await asyncio.shield(self.current)
+
+    async def flush(self, batch):
+        rows = [{"id": m.id, "account_id": m.account_id, "chat_id": m.chat_id, "text": m.text,
+                 "author_username": m.author_username, "seq": m.seq, "created_at": m.created_at}
+                for m in batch]
+        delay = 0.1
+        while rows:
+            try:
+                await self._write(rows)
+                return
+            except IntegrityError:
+                # One bad row (e.g. its chat was deleted) must not take the batch down
+                logger.warning("Batched insert of %d messages hit a constraint, writing row by row", len(rows))
+                rows = await self._write_each(rows)
+            except Exception:
+                logger.exception("Batched insert of %d messages failed, retrying in %.1fs", len(rows), delay)
+            if not rows:
+                return
+            if self.give_up_at is not None and asyncio.get_running_loop().time() >= self.give_up_at:
+                logger.error("Shutting down with %d messages unwritten", len(rows))
+                metrics.ingest_dropped.inc(len(rows), "shutdown")
+                return
+            metrics.ingest_retries.inc()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, INGEST_RETRY_MAX)
+
+    async def _write_each(self, rows):
+        # Drops rows that violate a constraint; returns the rest from the
+        # first row that failed any other way, to be retried
+        for i, row in enumerate(rows):
+            try:
+                await self._write([row])
+            except IntegrityError:
+                logger.exception("Dropping message %s for chat %s", row["id"], row["chat_id"])
+                metrics.ingest_dropped.inc(1, "integrity")
+            except Exception:
+                logger.exception("Writing message %s failed, will retry", row["id"])
+                return rows[i:]
+        return []
+
+    async def _write(self, rows):
+        last_seqs = {}
+        read_seqs = {}
+        for row in rows:
+            last_seqs[row["chat_id"]] = max(last_seqs.get(row["chat_id"], 0), row["seq"])
+            sender = (row["account_id"], row["chat_id"])
+            read_seqs[sender] = max(read_seqs.get(sender, 0), row["seq"])
+        async with self.session_factory() as db:
+            await db.execute(insert(models.Messages), rows)
+            for chat_id, seq in last_seqs.items():
+                await db.execute(update(models.Chats)
+                                 .where(models.Chats.id == chat_id)
+                                 .values(last_seq=case((models.Chats.last_seq < seq, seq), else_=models.Chats.last_seq)))
+            # Senders have read their chats up to their own newest message
+            for (account_id, chat_id), seq in read_seqs.items():
+                await db.execute(update(models.ChatMembers)
+                                 .where(models.ChatMembers.account_id == account_id,
+                                        models.ChatMembers.chat_id == chat_id,
+                                        models.ChatMembers.last_read_seq < seq)
+                                 .values(last_read_seq=seq))
+            await db.commit()
+
+    async def drain(self):
+        self.accepting = False
+        self.give_up_at = asyncio.get_running_loop().time() + INGEST_DRAIN_TIMEOUT
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.current is not None:
+            await self.current
+        batch, self.pending = self.pending, []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        for i in range(0, len(batch), INGEST_BATCH_SIZE):
+            await self.flush(batch[i:i + INGEST_BATCH_SIZE])
@@ -1,38 +1,135 @@
-from fastapi import FastAPI, HTTPException, Depends, status, WebSocketDisconnect, WebSocket
+import time
+IMPORT_STARTED = time.perf_counter()
+from fastapi import APIRouter, FastAPI, HTTPException, Depends, status, WebSocketDisconnect, WebSocket, Response, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
-from typing import List, Annotated
-from fastapi.staticfiles import StaticFiles
+from serialization import FastJSONResponse, Frame, dumps, loads, msgpack, unpackb
+from pydantic import AfterValidator, BaseModel, Field, TypeAdapter, ValidationError
+from typing import List, Annotated, Literal, Union
+from static import PrecompressedStaticFiles
 from pathlib import Path
-import models, auth
-from database import engine, get_db
-from sqlalchemy.orm import Session
+import models, auth, archive, cache, database, hashing, ingest, metrics, migrate, pagination, ratelimit, scheduler, search
+from database import async_engine, read_engine, get_async_db, AsyncSessionLocal, AsyncReadSessionLocal
+from sqlalchemy import insert, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
-from passlib.context import CryptContext
 from auth import (create_access_token, authenticate_user, ACCESS_TOKEN_EXPIRE_MINUTES, Token,
-                  get_current_active_user, get_user_from_token
+                  get_current_active_user, get_current_account, get_user_from_token
 )
 from fastapi.security import OAuth2PasswordRequestForm
-from datetime import timedelta
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from functools import partial
 import asyncio
+import logging
+
+# uvicorn configures this logger, so the startup summary shows up in its output
+logger = logging.getLogger("uvicorn.error")
 
 
 
 
 manager = models.ConnectionManager()
-app = FastAPI()
-models.Base.metadata.create_all(bind=engine)
+memberships = cache.MembershipCache()
+recent_sends = cache.TTLCache(maxsize=100000, ttl=300)
+recent_writes = cache.RecentWrites()
+batcher = ingest.MessageBatcher(AsyncSessionLocal) if ingest.MESSAGE_INGEST == "batch" else None
+limiter = ratelimit.get_limiter(async_engine)
+maintenance = scheduler.Scheduler(async_engine) if scheduler.SCHEDULER else None
+
+async def purge_caches():
+    return sum(c.purge() for c in (memberships, recent_sends, auth.decoded_tokens, auth.token_versions))
+
+if maintenance is not None:
+    maintenance.add("expire_invites", 3600, partial(scheduler.expire_invites, AsyncSessionLocal))
+    maintenance.add("prune_empty_chats", 3600, partial(scheduler.prune_empty_chats, AsyncSessionLocal))
+    maintenance.add("optimize", 86400, partial(scheduler.optimize, async_engine))
+    maintenance.add("purge_caches", 60, purge_caches, leader_only=False)
+    if ratelimit.RATE_LIMIT_BACKEND == "database":
+        maintenance.add("prune_rate_limits", 3600, partial(scheduler.prune_rate_limits, AsyncSessionLocal))
+    if archive.ARCHIVE_INTERVAL:
+        maintenance.add("archive", archive.ARCHIVE_INTERVAL, partial(archive.run_archiver, AsyncSessionLocal))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup = metrics.startup
+    if database.AUTO_MIGRATE:
+        with startup.phase("migrate"):
+            for change in await migrate.migrate(async_engine):
+                logger.info("Migrated: %s", change)
+    with startup.phase("db_pool"):
+        await asyncio.gather(*(database.warm_pool(e) for e in (async_engine, read_engine) if e is not None))
+    with startup.phase("hashing"):
+        await hashing.warm_up()
+    with startup.phase("broker"):
+        await memberships.start(manager.broker)
+        await auth.token_versions.start(manager.broker)
+        if read_engine is not None:
+            await recent_writes.start(manager.broker)
+    with startup.phase("background"):
+        manager.presence.start()
+        if batcher is not None:
+            batcher.start()
+        if maintenance is not None:
+            maintenance.start()
+    logger.info("Worker started in %s", startup.summary())
+    yield
+    if maintenance is not None:
+        await maintenance.stop()
+    if batcher is not None:
+        await batcher.drain()
+    await manager.close()
+    hashing.shutdown()
+
+router = APIRouter()
+
+metrics.instrument_engine(async_engine.sync_engine)
+if read_engine is not None:
+    metrics.instrument_engine(read_engine.sync_engine)
+
+@router.get("/capacity", include_in_schema=False)
+async def capacity(response: Response):
+    # For load balancer health checks: 503 once this worker takes no new sockets
+    sockets = manager.rooms.sockets
+    available = max(models.WS_MAX_SOCKETS - sockets, 0) if models.WS_MAX_SOCKETS else None
+    if available == 0:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"sockets": sockets, "max_sockets": models.WS_MAX_SOCKETS or None,
+            "available": available, "rooms": len(manager.rooms)}
+
+METRICS_TOP_ROOMS = 20
+metrics.Gauge("ws_open_sockets", "Open WebSockets in this worker.", lambda: manager.rooms.sockets)
+metrics.Gauge("ws_rooms", "Rooms this worker holds sockets for.", lambda: len(manager.rooms))
+metrics.Gauge("ws_room_sockets", f"Open sockets in the {METRICS_TOP_ROOMS} largest rooms.",
+              lambda: [((chat_id,), len(room)) for chat_id, room in manager.rooms.largest(METRICS_TOP_ROOMS)],
+              labels=("chat_id",))
+metrics.Gauge("membership_cache_hits", "Membership cache hits.", lambda: memberships.hits)
+metrics.Gauge("membership_cache_misses", "Membership cache misses.", lambda: memberships.misses)
+metrics.Gauge("scheduler_leader", "1 if this worker runs the shared scheduled jobs.",
+              lambda: int(maintenance is not None and maintenance.leader))
+metrics.Gauge("password_hash_pending", "bcrypt calls queued or running.", lambda: hashing.pending)
+metrics.Gauge("message_ingest_queue", "Messages waiting for a batched INSERT.",
+              lambda: batcher.queue.qsize() if batcher is not None else 0)
+
+db_dependency = Annotated[AsyncSession, Depends(get_async_db)]
+
+# History and listing routes read from the replica when one is configured,
+# except for an account that wrote in the last READ_YOUR_WRITES_TTL seconds:
+# those go to the primary so a sender always sees their own message.
+async def get_read_db(db: db_dependency, current_user: models.Accounts = Depends(get_current_active_user)):
+    if AsyncReadSessionLocal is None or recent_writes.recent(current_user.id):
+        metrics.db_reads.inc(1, "primary")
+        yield db
+        return
+    metrics.db_reads.inc(1, "replica")
+    async with AsyncReadSessionLocal() as read_db:
+        yield read_db
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"], # ONLY * WHEN IN DEV
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],)
+read_db_dependency = Annotated[AsyncSession, Depends(get_read_db)]
 
-db_dependency = Annotated[Session, Depends(get_db)]
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+async def wrote(current_user):
+    if read_engine is not None:
+        await recent_writes.mark(current_user.id)
 
 class SignUpBase(BaseModel):
     username: str
@@ -48,12 +145,33 @@ class GroupChatOut(BaseModel):
     created_by: int
     created_at: str
 
+class ReadMarkerBase(BaseModel):
+    seq: int
+
+class ReadMarkerOut(BaseModel):
+    chat_id: int
+    last_read_seq: int
+
+class RetentionBase(BaseModel):
+    days: int | None = Field(default=None, ge=1)
+
+class RetentionOut(BaseModel):
+    chat_id: int
+    days: int | None
+
 class UserOut(BaseModel):
     username: str
     email: str | None = None
 
+def check_message_size(text: str) -> str:
+    if len(dumps(text).encode()) > models.MESSAGE_MAX_BYTES:
+        raise ValueError(f"Message is longer than {models.MESSAGE_MAX_BYTES} bytes.")
+    return text
+
+MessageText = Annotated[str, AfterValidator(check_message_size)]
+
 class MessageBase(BaseModel):
-    text: str
+    text: MessageText
 
 class MessageOut(BaseModel):
     id: int
@@ -62,6 +180,43 @@ class MessageOut(BaseModel):
     text: str
     created_at: str
     author_username: str
+    seq: int | None = None
+
+class WsSendFrame(BaseModel):
+    type: Literal["send"]
+    text: MessageText
+    client_id: str | None = Field(default=None, max_length=64)
+
+class WsTypingFrame(BaseModel):
+    type: Literal["typing"]
+
+class WsPongFrame(BaseModel):
+    type: Literal["pong"]
+
+inbound_frame = TypeAdapter(Annotated[Union[WsSendFrame, WsTypingFrame, WsPongFrame], Field(discriminator="type")])
+
+def frame_error(message, error: ValidationError) -> dict:
+    # A validator's own message (an oversized text, say) is worth showing, and
+    # the client_id, when the frame has one, tells the client which send failed
+    detail = next((str(e["ctx"]["error"]) for e in error.errors() if e["type"] == "value_error"), "Malformed frame.")
+    try:
+        raw = unpackb(message["bytes"]) if message.get("bytes") is not None else loads(message["text"])
+        client_id = raw.get("client_id")
+    except Exception:
+        client_id = None
+    return {"type": "error", "client_id": client_id if isinstance(client_id, str) else None, "detail": detail}
+
+class PresenceUser(BaseModel):
+    account_id: int
+    username: str
+
+class PresenceOut(BaseModel):
+    online: List[PresenceUser]
+    typing: List[PresenceUser]
+
+class GroupChatSummaryOut(GroupChatOut):
+    last_message: MessageOut | None = None
+    unread_count: int | None = None
 
 class InviteBase(BaseModel):
     receiver_id: int
@@ -77,6 +232,23 @@ class InviteOut(BaseModel):
     status: str
     created_at: str
 
+INVITE_BULK_MAX = 500
+
+class BulkInviteBase(BaseModel):
+    chat_id: int
+    receiver_ids: List[int] = Field(min_length=1, max_length=INVITE_BULK_MAX)
+    text: str
+
+class BulkInviteIds(BaseModel):
+    invite_ids: List[int] = Field(min_length=1, max_length=INVITE_BULK_MAX)
+
+class InviteResult(BaseModel):
+    # One per requested receiver or invite, in request order
+    id: int
+    ok: bool
+    invite: InviteOut | None = None
+    detail: str | None = None
+
 class UserOutWithID(BaseModel):
     user_id: int
     username: str
@@ -84,41 +256,215 @@ class UserOutWithID(BaseModel):
 
 member = []
 
-@app.websocket("/gc/{chat_id}/ws")
-async def chat_ws(websocket: WebSocket, chat_id: int, db: Session = Depends(get_db)):
+def message_out(m: models.Messages):
+    return {
+        "id" : m.id,
+        "account_id" : m.account_id if m.account_id is not None else 0,
+        "chat_id" : m.chat_id,
+        "text" : m.text,
+        "created_at" : m.created_at.isoformat(),
+        "author_username" : m.author_username,
+        "seq" : m.seq
+    }
+
+def invite_out(inv: models.Invites):
+    return {
+        "id" : inv.id,
+        "sender_id" : inv.sender_id,
+        "receiver_id" : inv.receiver_id,
+        "chat_id" : inv.chat_id,
+        "text" : inv.text,
+        "status" : inv.status,
+        "created_at" : inv.created_at.isoformat()
+    }
+
+def message_event(m: models.Messages):
+    return {"type": "message", "seq": m.seq, "payload": message_out(m)}
+
+async def check_send_rate(chat_id: int, current_user):
+    # One flooding sender hits their own limit before the room's shared one
+    await limiter.check("message", current_user.id)
+    await limiter.check("chat_message", chat_id)
+
+async def create_message(db: AsyncSession, chat_id: int, current_user, text: str):
+    await wrote(current_user)
+    if batcher is not None:
+        return await batcher.submit(db, chat_id, current_user, text)
+    try:
+        # Per-chat sequence number, bumped in the same transaction as the insert
+        seq = await db.scalar(update(models.Chats)
+                              .where(models.Chats.id == chat_id)
+                              .values(last_seq=models.Chats.last_seq + 1)
+                              .returning(models.Chats.last_seq))
+        m = models.Messages(
+            account_id = current_user.id,
+            chat_id = chat_id,
+            text = text,
+            author_username = current_user.username,
+            seq = seq
+        )
+        db.add(m)
+        # Sending means the sender has read the chat up to their own message
+        await db.execute(update(models.ChatMembers)
+                         .where(models.ChatMembers.account_id == current_user.id,
+                                models.ChatMembers.chat_id == chat_id,
+                                models.ChatMembers.last_read_seq < seq)
+                         .values(last_read_seq=seq))
+        await db.commit()
+        await db.refresh(m)
+    except:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="Unexpected server error.")
+    return m
+
+PING_FRAME = Frame(dumps({"type": "ping"}))
+WS_UNSUPPORTED_ENCODING_CODE = 4415
+
+def ws_encoding(websocket: WebSocket):
+    # ?encoding= wins over the subprotocol list. Returns (subprotocol to
+    # accept, binary), or None when the client only asked for something we
+    # can't speak.
+    offered = websocket.scope.get("subprotocols") or []
+    wanted = websocket.query_params.get("encoding")
+    if wanted is None:
+        wanted = "msgpack" if "msgpack" in offered and msgpack is not None else "json"
+        if offered and wanted not in offered:
+            return None
+    if wanted not in ("json", "msgpack") or (wanted == "msgpack" and msgpack is None):
+        return None
+    return (wanted if wanted in offered else None), wanted == "msgpack"
+
+@router.websocket("/gc/{chat_id}/ws")
+async def chat_ws(websocket: WebSocket, chat_id: int):
     token = websocket.query_params.get("token")
     if not token:
         await websocket.close(code=4401)
         return
 
-    try:
-        current_user = auth.get_user_from_token(token, db)
-    except HTTPException:
-        await websocket.close(code=4401)
-        return
+    # Short-lived session: the socket can stay open for hours and must not pin a pooled connection.
+    async with AsyncSessionLocal() as db:
+        try:
+            current_user = await auth.get_user_from_token(token, db)
+        except HTTPException:
+            await websocket.close(code=4401)
+            return
 
-    is_member = db.query(models.ChatMembers).filter_by(
-        account_id=current_user.id, chat_id=chat_id
-    ).first()
+        is_member = await memberships.is_member(db, current_user.id, chat_id)
     if not is_member:
         await websocket.close(code=4403)
         return
 
-    await manager.connect(chat_id, websocket)
+    encoding = ws_encoding(websocket)
+    if encoding is None:
+        await websocket.close(code=WS_UNSUPPORTED_ENCODING_CODE)
+        return
+
+    conn = await manager.connect(chat_id, websocket, current_user, *encoding)
+    if conn is None:
+        return
 
+    # Everything after connect must end in disconnect, or the socket's
+    # registry entry, writer task and presence outlive it
     try:
+        # ?since_seq=N replays what the client missed: from the room's ring buffer
+        # when it still covers the gap, otherwise from the message table.
+        since_seq = websocket.query_params.get("since_seq", "")
+        since_seq = int(since_seq) if since_seq.isdigit() else None
+        backlog = []
+        if since_seq is not None:
+            backlog = manager.replay(chat_id, since_seq)
+            if backlog is None:
+                async with AsyncSessionLocal() as db:
+                    rows = (await db.scalars(select(models.Messages)
+                            .where(models.Messages.chat_id == chat_id, models.Messages.seq > since_seq)
+                            .order_by(models.Messages.seq)
+                            .limit(models.WS_REPLAY_DB_LIMIT))).all()
+                backlog = [(m.seq, dumps(message_event(m))) for m in rows]
+                if len(rows) == models.WS_REPLAY_DB_LIMIT:
+                    # Too far behind to replay; the client should refetch over REST
+                    backlog.append((None, dumps({"type": "resync"})))
+        backlog.append((None, dumps({"type": "presence", "payload": manager.presence.snapshot(chat_id)})))
+        conn.start(backlog, since_seq or 0)
+
+        # Any inbound frame proves the peer is alive; pings only go to quiet sockets
+        pinged = False
         while True:
-            await websocket.receive_text()
+            try:
+                message = await asyncio.wait_for(websocket.receive(), models.WS_PING_INTERVAL)
+            except asyncio.TimeoutError:
+                if pinged:
+                    conn.evict(models.WS_DEAD_PEER_CODE)
+                    return
+                pinged = True
+                conn.send(PING_FRAME)
+                continue
+            pinged = False
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            try:
+                if message.get("bytes") is not None:
+                    frame = inbound_frame.validate_python(unpackb(message["bytes"]))
+                else:
+                    frame = inbound_frame.validate_json(message["text"])
+            except ValidationError as e:
+                conn.send(dumps(frame_error(message, e)))
+                continue
+            except ValueError:
+                conn.send(dumps({"type": "error", "detail": "Malformed frame."}))
+                continue
+            try:
+                await handle_frame(conn, chat_id, current_user, frame)
+            except Exception:
+                # One failed send (a DB error, say) shouldn't take the socket down
+                logger.exception("Failed to handle a frame in chat %s", chat_id)
+                conn.send(dumps({"type": "error", "client_id": getattr(frame, "client_id", None),
+                                 "detail": "Unexpected server error."}))
     except WebSocketDisconnect:
-        manager.disconnect(chat_id, websocket)
-
+        pass
+    finally:
+        await manager.disconnect(chat_id, websocket)
+
+# Frames sent over an open socket reuse the identity and membership checked at
+# connect time, so a message costs one INSERT plus the fan-out.
+async def handle_frame(conn, chat_id: int, current_user, frame):
+    if frame.type == "pong":
+        return
+    if frame.type == "typing":
+        manager.presence.typing(chat_id, current_user.id, current_user.username)
+        return
 
-@app.post("/sign_up")
+    # Clients retry sends with the same client_id; answer those from memory
+    key = (current_user.id, frame.client_id)
+    if frame.client_id is not None:
+        sent = recent_sends.get(key)
+        if sent is not cache.MISSING:
+            conn.send(dumps({"type": "ack", "client_id": frame.client_id, "payload": sent}))
+            return
+
+    async with AsyncSessionLocal() as db:
+        try:
+            await check_send_rate(chat_id, current_user)
+            m = await create_message(db, chat_id, current_user, frame.text)
+        except HTTPException as e:
+            error = {"type": "error", "client_id": frame.client_id, "detail": e.detail}
+            if e.status_code == status.HTTP_429_TOO_MANY_REQUESTS:
+                error["retry_after"] = int(e.headers["Retry-After"])
+            conn.send(dumps(error))
+            return
+
+    event = message_event(m)
+    if frame.client_id is not None:
+        recent_sends.set(key, event["payload"])
+    conn.send(dumps({"type": "ack", "client_id": frame.client_id, "payload": event["payload"]}))
+    await manager.broadcast(chat_id, event, seq=m.seq)
+
+
+@router.post("/sign_up")
 async def add_account(account: SignUpBase, db: db_dependency):
-    existing_user = db.query(models.Accounts).filter(
+    existing_user = await db.scalar(select(models.Accounts).where(
     (models.Accounts.username == account.username) |
     (models.Accounts.email == account.email)
-    ).first()
+    ))
 
     if existing_user:
         if existing_user.username == account.username:
@@ -128,16 +474,16 @@ async def add_account(account: SignUpBase, db: db_dependency):
     
     new_chat = models.Accounts(username=account.username,
                                 email=account.email,
-                                password=auth.get_password_hash(account.password))
+                                password=await auth.get_password_hash(account.password))
     db.add(new_chat)
     try:
-        db.commit()
-        db.refresh(new_chat)
+        await db.commit()
+        await db.refresh(new_chat)
     except IntegrityError as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=409, detail="Username or email already in use.")
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Unexpected server error.")
 
     return {
@@ -147,43 +493,55 @@ async def add_account(account: SignUpBase, db: db_dependency):
         "created_at": new_chat.created_at.isoformat(),
     }
     
-@app.get("/accounts/{account_id}")
+@router.get("/accounts/{account_id}")
 async def get_account(account_id: int, db: db_dependency):
-    result = db.query(models.Accounts).filter(models.Accounts.id == account_id).first()
+    result = await db.get(models.Accounts, account_id)
     if not result:
         raise HTTPException(status_code=404, detail='Account not found')
     return result.username
 
-@app.post("/token", response_model=Token)
-async def login_for_access_token(db: db_dependency, form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(db, form_data.username, form_data.password)
+@router.post("/token", response_model=Token)
+async def login_for_access_token(db: db_dependency, request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    await limiter.check("token", ratelimit.client_ip(request))
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password", headers={"WWW-Authenticate" : "Bearer"})
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    token = create_access_token(data={"sub" : str(user.id)}, expires_delta=access_token_expires)
+    token = create_access_token(data={"sub" : str(user.id), "username" : user.username, "ver" : user.token_version},
+                                expires_delta=access_token_expires)
     return {"access_token" : token, "token_type" : "bearer"}
 
-@app.get("/users/me/", response_model=UserOutWithID)
-async def read_users_me(current_user: models.Accounts = Depends(get_current_active_user)):
+@router.post("/logout")
+async def logout(db: db_dependency, current_user: models.Accounts = Depends(get_current_account)):
+    # Invalidates every token issued to this account so far
+    current_user.token_version += 1
+    await db.commit()
+    await auth.token_versions.invalidate(current_user.id, current_user.token_version)
+    return {"detail" : "Logged out"}
+
+@router.get("/users/me/", response_model=UserOutWithID)
+async def read_users_me(current_user: models.Accounts = Depends(get_current_account)):
     return UserOutWithID(user_id=current_user.id, username=current_user.username, email=current_user.email)
 
-@app.post("/gc", response_model=GroupChatOut)
+@router.post("/gc", response_model=GroupChatOut)
 async def create_group_chat(db:db_dependency, group_chat: GroupChatBase, current_user: models.Accounts = Depends(get_current_active_user)):
-    existing = db.query(models.Chats).filter_by(
+    existing = await db.scalar(select(models.Chats).filter_by(
         name=group_chat.name, created_by=current_user.id
-    ).first()
+    ))
     if existing:
         raise HTTPException(409, "Chat with that name already exists")
     new_chat = models.Chats(name=group_chat.name, created_by=current_user.id)
     db.add(new_chat)
     try:
-        db.flush()
+        await db.flush()
         db.add(models.ChatMembers(account_id=current_user.id, chat_id=new_chat.id))
-        db.commit()
-        db.refresh(new_chat)
+        await db.commit()
+        await db.refresh(new_chat)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Unexpected server error.")
+    memberships.set((current_user.id, new_chat.id), True)
+    await wrote(current_user)
     return {
         "id": new_chat.id,
         "name": new_chat.name,
@@ -191,31 +549,63 @@ async def create_group_chat(db:db_dependency, group_chat: GroupChatBase, current
         "created_at": new_chat.created_at.isoformat(),
     }
 
-@app.get("/gc", response_model=List[GroupChatOut])
-async def get_all_chats(db: db_dependency, limit: int = 50, current_user: models.Accounts = Depends(get_current_active_user)):
-    rows = (db.query(models.Chats)
+@router.get("/gc", response_model=List[GroupChatSummaryOut], response_model_exclude_unset=True)
+async def get_all_chats(db: read_db_dependency, limit: int = 50, summary: bool = False,
+                        current_user: models.Accounts = Depends(get_current_active_user)):
+    chats = (select(models.Chats)
             .join(models.ChatMembers, models.ChatMembers.chat_id == models.Chats.id)
-            .filter(models.ChatMembers.account_id == current_user.id)
+            .where(models.ChatMembers.account_id == current_user.id)
             .order_by(models.Chats.created_at.desc())
-            .limit(min(max(limit, 1), 200))
-            .all())
+            .limit(min(max(limit, 1), 200)))
+
+    if not summary:
+        rows = [(c, None, None) for c in (await db.scalars(chats)).all()]
+    else:
+        # The newest message is the one whose seq equals the chat's last_seq, so
+        # previews and unread counts come out of this one query.
+        rows = (await db.execute(chats
+                .add_columns(models.ChatMembers.last_read_seq, models.Messages)
+                .outerjoin(models.Messages, (models.Messages.chat_id == models.Chats.id) &
+                                            (models.Messages.seq == models.Chats.last_seq)))).all()
 
     out = []
 
-    for c in rows:
-        out.append({
+    for c, last_read_seq, last_message in rows:
+        chat = {
             "id": c.id,
             "name": c.name,
             "created_by" : c.created_by,
             "created_at": c.created_at.isoformat()
-        })
+        }
+        if summary:
+            chat["last_message"] = message_out(last_message) if last_message else None
+            chat["unread_count"] = max(c.last_seq - last_read_seq, 0)
+        out.append(chat)
 
     return list(reversed(out))
 
-@app.get("/gc/created", response_model=List[GroupChatOut])
-async def get_created_chats(db: db_dependency, limit: int = 50, current_user: models.Accounts = Depends(get_current_active_user)):
-    chats = (db.query(models.Chats).filter(models.Chats.created_by == current_user.id))
-    rows = chats.order_by(models.Chats.created_at.desc()).limit(min(max(limit, 1), 200)).all()
+@router.post("/gc/{chat_id}/read", response_model=ReadMarkerOut)
+async def mark_read(db: db_dependency, chat_id: int, marker: ReadMarkerBase, current_user: models.Accounts = Depends(get_current_active_user)):
+    member = await db.get(models.ChatMembers, (current_user.id, chat_id))
+    if not member:
+        raise HTTPException(status_code=403, detail="Not a member of this chat.")
+
+    # Markers only move forward, so out-of-order requests from several tabs are
+    # harmless, and never past the chat's newest message, so a bogus seq can't
+    # hide messages that haven't been sent yet
+    last_seq = await db.scalar(select(models.Chats.last_seq).where(models.Chats.id == chat_id))
+    seq = min(marker.seq, last_seq or 0)
+    if seq > member.last_read_seq:
+        member.last_read_seq = seq
+        await db.commit()
+        await wrote(current_user)
+
+    return {"chat_id" : chat_id, "last_read_seq" : member.last_read_seq}
+
+@router.get("/gc/created", response_model=List[GroupChatOut])
+async def get_created_chats(db: read_db_dependency, limit: int = 50, current_user: models.Accounts = Depends(get_current_active_user)):
+    chats = select(models.Chats).where(models.Chats.created_by == current_user.id)
+    rows = (await db.scalars(chats.order_by(models.Chats.created_at.desc()).limit(min(max(limit, 1), 200)))).all()
 
     out = []
 
@@ -229,93 +619,140 @@ async def get_created_chats(db: db_dependency, limit: int = 50, current_user: mo
 
     return list(reversed(out))
 
-@app.post("/gc/{chat_id}/messages", response_model=MessageOut)
+@router.post("/gc/{chat_id}/messages", response_model=MessageOut)
 async def send_message(db: db_dependency, chat_id: int, message: MessageBase, current_user: models.Accounts = Depends(get_current_active_user)):
-    chat = db.query(models.Chats).filter(chat_id == models.Chats.id).first()
+    chat = await db.get(models.Chats, chat_id)
 
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found.")
     
-    member = db.query(models.ChatMembers).filter_by(account_id=current_user.id, chat_id=chat_id).first()
-    if not member:
+    if not await memberships.is_member(db, current_user.id, chat_id):
         raise HTTPException(status_code=403, detail="Not a member of this chat.")
     
-    m = models.Messages(
-        account_id = current_user.id,
-        chat_id = chat_id,
-        text = message.text,
-        author_username = current_user.username
-    )
-
-    db.add(m)
-    try:
-        db.commit()
-        db.refresh(m)
-    except:
-        db.rollback()
-        raise HTTPException(status_code=500, detail="Unexpected server error.")
-    
-    msg_out = {
-        "id" : m.id,
-        "account_id" : m.account_id,
-        "chat_id" : m.chat_id,
-        "text" : m.text,
-        "created_at" : m.created_at.isoformat(),
-        "author_username" : m.author_username
-    }
-
-    asyncio.create_task(manager.broadcast(chat_id, {"type": "message", "payload": msg_out}))
-    return msg_out
-
-@app.get("/gc/{chat_id}/messages", response_model=List[MessageOut])
-async def get_message(db: db_dependency, chat_id: int, limit: int = 50, current_user: models.Accounts = Depends(get_current_active_user)):
-    member = db.query(models.ChatMembers).filter_by(account_id=current_user.id, chat_id=chat_id).first()
-    if not member:
+    await check_send_rate(chat_id, current_user)
+    m = await create_message(db, chat_id, current_user, message.text)
+    event = message_event(m)
+
+    asyncio.create_task(manager.broadcast(chat_id, event, seq=m.seq))
+    return event["payload"]
+
+@router.get("/gc/{chat_id}/messages", response_model=List[MessageOut])
+async def get_message(db: read_db_dependency, chat_id: int, response: Response, limit: int = 50,
+                      before: str | None = None, after: str | None = None,
+                      current_user: models.Accounts = Depends(get_current_active_user)):
+    if not await memberships.is_member_on_primary(AsyncSessionLocal, current_user.id, chat_id):
         raise HTTPException(status_code=403, detail="Not a member of this chat.")
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both.")
     
-    messages = db.query(models.Messages).filter(models.Messages.chat_id == chat_id)
-
-    rows = messages.order_by(models.Messages.created_at.desc()).limit(min(max(limit, 1), 200)).all()
+    limit = min(max(limit, 1), 200)
+    columns = (models.Messages.created_at, models.Messages.id)
+    key = tuple_(*columns)
+    messages = select(models.Messages).where(models.Messages.chat_id == chat_id)
+
+    # after=<cursor> walks forward from a known message (delta sync), otherwise
+    # we page backwards from the newest message or from before=<cursor>.
+    # Either way, cursors that reach past the hot table continue into the
+    # archive (anything at or before group_chat.archived_until).
+    if after:
+        after_key = pagination.decode_cursor(after)
+        messages = messages.where(key > pagination.cursor_row(columns, after_key))
+        out = []
+        chat = await db.get(models.Chats, chat_id)
+        if chat and chat.archived_until and after_key[0] <= chat.archived_until:
+            out = await archive.read_archive(chat_id, after=after_key, limit=limit)
+        if len(out) < limit:
+            rows = (await db.scalars(messages.order_by(models.Messages.created_at, models.Messages.id).limit(limit - len(out)))).all()
+            out += [message_out(m) for m in rows]
+    else:
+        before_key = pagination.decode_cursor(before) if before else None
+        if before_key:
+            messages = messages.where(key < pagination.cursor_row(columns, before_key))
+        rows = (await db.scalars(messages.order_by(models.Messages.created_at.desc(), models.Messages.id.desc()).limit(limit))).all()
+        out = [message_out(m) for m in reversed(rows)]
+        if len(out) < limit:
+            chat = await db.get(models.Chats, chat_id)
+            if chat and chat.archived_until:
+                if rows:
+                    before_key = (rows[-1].created_at, rows[-1].id)
+                out = await archive.read_archive(chat_id, before=before_key, limit=limit - len(out)) + out
+
+    # X-Prev-Cursor pages further back, X-Next-Cursor fetches anything newer
+    if out:
+        response.headers["X-Prev-Cursor"] = pagination.encode_cursor(datetime.fromisoformat(out[0]["created_at"]), out[0]["id"])
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(datetime.fromisoformat(out[-1]["created_at"]), out[-1]["id"])
+    elif after:
+        response.headers["X-Next-Cursor"] = after
+
+    return out
+
+@router.get("/gc/{chat_id}/presence", response_model=PresenceOut)
+async def get_presence(db: db_dependency, chat_id: int, current_user: models.Accounts = Depends(get_current_active_user)):
+    if not await memberships.is_member(db, current_user.id, chat_id):
+        raise HTTPException(status_code=403, detail="Not a member of this chat.")
+    return manager.presence.snapshot(chat_id)
 
-    out = []
-    
-    for m in rows:
-        out.append({
-            "id" : m.id,
-            "account_id" : m.account_id if m.account_id is not None else 0,
-            "chat_id" : m.chat_id,
-            "text" : m.text,
-            "created_at" : m.created_at.isoformat(),
-            "author_username" : m.author_username
-        })
+@router.put("/gc/{chat_id}/retention", response_model=RetentionOut)
+async def set_retention(db: db_dependency, chat_id: int, retention: RetentionBase, current_user: models.Accounts = Depends(get_current_active_user)):
+    chat = await db.get(models.Chats, chat_id)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found.")
+    if chat.created_by != current_user.id:
+        raise HTTPException(status_code=403, detail="Only the chat creator can change retention.")
 
-    return list(reversed(out))
+    chat.retention_days = retention.days
+    await db.commit()
+    return {"chat_id" : chat.id, "days" : chat.retention_days}
 
-@app.post("/gc/invites", response_model=InviteOut)
+@router.get("/gc/{chat_id}/messages/search", response_model=List[MessageOut])
+async def search_chat_messages(db: read_db_dependency, chat_id: int, q: str, response: Response, limit: int = 20,
+                               cursor: str | None = None, current_user: models.Accounts = Depends(get_current_active_user)):
+    if not await memberships.is_member_on_primary(AsyncSessionLocal, current_user.id, chat_id):
+        raise HTTPException(status_code=403, detail="Not a member of this chat.")
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Search query is empty.")
+
+    rows, next_cursor = await search.search_messages(db, q, [chat_id], min(max(limit, 1), 100), cursor)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [message_out(m) for m in rows]
+
+@router.get("/messages/search", response_model=List[MessageOut])
+async def search_all_messages(db: read_db_dependency, q: str, response: Response, limit: int = 20,
+                              cursor: str | None = None, current_user: models.Accounts = Depends(get_current_active_user)):
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Search query is empty.")
+
+    my_chats = select(models.ChatMembers.chat_id).where(models.ChatMembers.account_id == current_user.id)
+    rows, next_cursor = await search.search_messages(db, q, my_chats, min(max(limit, 1), 100), cursor)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [message_out(m) for m in rows]
+
+@router.post("/gc/invites", response_model=InviteOut)
 async def create_invite(db: db_dependency, invite: InviteBase, current_user: models.Accounts = Depends(get_current_active_user)):
+    await limiter.check("invite", current_user.id)
     if invite.receiver_id == current_user.id:
         raise HTTPException(status_code=400,detail="Cannot invite yourself.")
     
-    chat = db.query(models.Chats).filter(invite.chat_id == models.Chats.id).first()
+    chat = await db.get(models.Chats, invite.chat_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found.")
     
-    inviter_member = (db.query(models.ChatMembers).filter_by(account_id=current_user.id, chat_id=invite.chat_id).first())
-    if not inviter_member:
+    if not await memberships.is_member(db, current_user.id, invite.chat_id):
         raise HTTPException(status_code=403, detail="You are not a member of this chat.")
     
-    receiver = db.query(models.Accounts).filter(invite.receiver_id == models.Accounts.id).first()
+    receiver = await db.get(models.Accounts, invite.receiver_id)
     if not receiver:
         raise HTTPException(status_code=404, detail="Account not found.")
     
-    already_member = (db.query(models.ChatMembers).filter_by(account_id=invite.receiver_id, chat_id=invite.chat_id).first())
-    if already_member:
+    if await memberships.is_member(db, invite.receiver_id, invite.chat_id):
         raise HTTPException(status_code=409, detail="User is already a member of this chat.")
     
-    pending = (db.query(models.Invites).filter(
+    pending = await db.scalar(select(models.Invites.id).where(
                                                 models.Invites.receiver_id == invite.receiver_id,
                                                 models.Invites.chat_id == invite.chat_id,
-                                                models.Invites.status == "pending",).first())
+                                                models.Invites.status == "pending",).limit(1))
     if pending:
         raise HTTPException(status_code=409, detail="An invite is already pending for this user.")
     
@@ -328,10 +765,10 @@ async def create_invite(db: db_dependency, invite: InviteBase, current_user: mod
     
     db.add(m)
     try:
-        db.commit()
-        db.refresh(m)
+        await db.commit()
+        await db.refresh(m)
     except:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Unexpected server error.")
     
     return {
@@ -344,10 +781,107 @@ async def create_invite(db: db_dependency, invite: InviteBase, current_user: mod
         "created_at" : m.created_at.isoformat()
     }
 
-@app.get("/invites", response_model=List[InviteOut])
-async def get_invites(db: db_dependency, limit: int = 50, current_user: models.Accounts = Depends(get_current_active_user)):  
-    invites = db.query(models.Invites).filter(models.Invites.receiver_id == current_user.id, models.Invites.status == "pending")
-    rows = invites.order_by(models.Invites.created_at.desc()).limit(min(max(limit, 1), 200)).all()
+# Same checks as create_invite, but each one is a single query over the whole
+# list, and every valid receiver goes into one INSERT.
+@router.post("/gc/invites/bulk", response_model=List[InviteResult])
+async def create_invites_bulk(db: db_dependency, invites: BulkInviteBase, current_user: models.Accounts = Depends(get_current_active_user)):
+    await limiter.check("bulk_invite", current_user.id)
+    chat = await db.get(models.Chats, invites.chat_id)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found.")
+
+    if not await memberships.is_member(db, current_user.id, invites.chat_id):
+        raise HTTPException(status_code=403, detail="You are not a member of this chat.")
+
+    receiver_ids = list(dict.fromkeys(invites.receiver_ids))
+    accounts = set(await db.scalars(select(models.Accounts.id).where(models.Accounts.id.in_(receiver_ids))))
+    members = set(await db.scalars(select(models.ChatMembers.account_id).where(
+                                            models.ChatMembers.chat_id == invites.chat_id,
+                                            models.ChatMembers.account_id.in_(receiver_ids))))
+    pending = set(await db.scalars(select(models.Invites.receiver_id).where(
+                                            models.Invites.chat_id == invites.chat_id,
+                                            models.Invites.status == "pending",
+                                            models.Invites.receiver_id.in_(receiver_ids))))
+
+    errors = {}
+    for receiver_id in receiver_ids:
+        if receiver_id == current_user.id:
+            errors[receiver_id] = "Cannot invite yourself."
+        elif receiver_id not in accounts:
+            errors[receiver_id] = "Account not found."
+        elif receiver_id in members:
+            errors[receiver_id] = "User is already a member of this chat."
+        elif receiver_id in pending:
+            errors[receiver_id] = "An invite is already pending for this user."
+
+    rows = [{"sender_id": current_user.id, "receiver_id": receiver_id, "chat_id": invites.chat_id,
+             "text": invites.text, "status": "pending"}
+            for receiver_id in receiver_ids if receiver_id not in errors]
+    # Every invite sent spends from the same bucket as single invites
+    if rows:
+        await limiter.check("invite", current_user.id, cost=len(rows))
+    created = {}
+    if rows:
+        try:
+            result = await db.scalars(insert(models.Invites).returning(models.Invites), rows)
+            created = {inv.receiver_id: invite_out(inv) for inv in result.all()}
+            await db.commit()
+        except:
+            await db.rollback()
+            raise HTTPException(status_code=500, detail="Unexpected server error.")
+
+    return [{"id": receiver_id, "ok": True, "invite": created[receiver_id]} if receiver_id in created
+            else {"id": receiver_id, "ok": False, "detail": errors[receiver_id]}
+            for receiver_id in receiver_ids]
+
+async def resolve_invites(db: AsyncSession, current_user, invite_ids, status: str):
+    invite_ids = list(dict.fromkeys(invite_ids))
+    found = {inv.id: inv for inv in await db.scalars(select(models.Invites).where(
+                                            models.Invites.id.in_(invite_ids),
+                                            models.Invites.receiver_id == current_user.id))}
+    resolving = [inv for inv in found.values() if inv.status == "pending"]
+    chat_ids = {inv.chat_id for inv in resolving}
+
+    if resolving:
+        if status == "accepted":
+            joined = set(await db.scalars(select(models.ChatMembers.chat_id).where(
+                                            models.ChatMembers.account_id == current_user.id,
+                                            models.ChatMembers.chat_id.in_(chat_ids))))
+            if chat_ids - joined:
+                await db.execute(insert(models.ChatMembers),
+                                 [{"account_id": current_user.id, "chat_id": chat_id} for chat_id in chat_ids - joined])
+        await db.execute(update(models.Invites)
+                         .where(models.Invites.id.in_([inv.id for inv in resolving]))
+                         .values(status=status))
+        await db.commit()
+        await wrote(current_user)
+        if status == "accepted":
+            for chat_id in chat_ids:
+                await memberships.invalidate((current_user.id, chat_id), True)
+
+    results = []
+    for invite_id in invite_ids:
+        inv = found.get(invite_id)
+        if inv is None:
+            results.append({"id": invite_id, "ok": False, "detail": "Invite not found."})
+        elif inv not in resolving:
+            results.append({"id": invite_id, "ok": False, "detail": "Invite already resolved."})
+        else:
+            results.append({"id": invite_id, "ok": True, "invite": invite_out(inv)})
+    return results
+
+@router.post("/invites/bulk/accept", response_model=List[InviteResult])
+async def accept_invites_bulk(db: db_dependency, invites: BulkInviteIds, current_user: models.Accounts = Depends(get_current_active_user)):
+    return await resolve_invites(db, current_user, invites.invite_ids, "accepted")
+
+@router.post("/invites/bulk/decline", response_model=List[InviteResult])
+async def decline_invites_bulk(db: db_dependency, invites: BulkInviteIds, current_user: models.Accounts = Depends(get_current_active_user)):
+    return await resolve_invites(db, current_user, invites.invite_ids, "declined")
+
+@router.get("/invites", response_model=List[InviteOut])
+async def get_invites(db: read_db_dependency, limit: int = 50, current_user: models.Accounts = Depends(get_current_active_user)):  
+    invites = select(models.Invites).where(models.Invites.receiver_id == current_user.id, models.Invites.status == "pending")
+    rows = (await db.scalars(invites.order_by(models.Invites.created_at.desc()).limit(min(max(limit, 1), 200)))).all()
 
     out = []
     
@@ -364,23 +898,25 @@ async def get_invites(db: db_dependency, limit: int = 50, current_user: models.A
 
     return list(reversed(out))
 
-@app.post("/invites/{invite_id}/accept", response_model=InviteOut)
+@router.post("/invites/{invite_id}/accept", response_model=InviteOut)
 async def accept_invite(db: db_dependency, invite_id: int, current_user: models.Accounts = Depends(get_current_active_user)):
-    invite = db.query(models.Invites).filter(models.Invites.id == invite_id, models.Invites.receiver_id == current_user.id).first()
+    invite = await db.scalar(select(models.Invites).where(models.Invites.id == invite_id, models.Invites.receiver_id == current_user.id))
     if not invite:
         raise HTTPException(status_code=404, detail="Invite not found.")
     elif invite.status != "pending":
         raise HTTPException(status_code=409, detail="Invite already resolved.")
     
-    exists = db.query(models.ChatMembers).filter_by(account_id=current_user.id, chat_id=invite.chat_id).first()
+    exists = await db.get(models.ChatMembers, (current_user.id, invite.chat_id))
     
     if not exists:
         db.add(models.ChatMembers(account_id=current_user.id, chat_id=invite.chat_id))
 
     invite.status="accepted"
     db.add(invite)
-    db.commit()
-    db.refresh(invite)
+    await db.commit()
+    await db.refresh(invite)
+    await memberships.invalidate((current_user.id, invite.chat_id), True)
+    await wrote(current_user)
 
 
     return {"id" : invite.id,
@@ -392,9 +928,9 @@ async def accept_invite(db: db_dependency, invite_id: int, current_user: models.
             "created_at" : invite.created_at.isoformat()
             }
 
-@app.post("/invites/{invite_id}/decline", response_model=InviteOut)
+@router.post("/invites/{invite_id}/decline", response_model=InviteOut)
 async def decline_invite(db: db_dependency, invite_id: int, current_user: models.Accounts = Depends(get_current_active_user)):
-    invite = db.query(models.Invites).filter(models.Invites.id == invite_id, models.Invites.receiver_id == current_user.id).first()
+    invite = await db.scalar(select(models.Invites).where(models.Invites.id == invite_id, models.Invites.receiver_id == current_user.id))
     
     if not invite:
         raise HTTPException(status_code=404, detail="Invite not found.")
@@ -403,8 +939,9 @@ async def decline_invite(db: db_dependency, invite_id: int, current_user: models
     
     invite.status="declined"
     db.add(invite)
-    db.commit()
-    db.refresh(invite)
+    await db.commit()
+    await db.refresh(invite)
+    await wrote(current_user)
 
     return {"id" : invite.id,
             "sender_id" : invite.sender_id,
@@ -417,4 +954,30 @@ async def decline_invite(db: db_dependency, invite_id: int, current_user: models
 
 
 FRONTEND_DIR = Path(__file__).resolve().parent / ".." / "frontend" / "dist"
-app.mount("/", StaticFiles(directory=str(FRONTEND_DIR), html=True), name="static")
\ No newline at end of file
+
+# The schema is not touched here: run `python migrate.py` before starting
+# workers (or set AUTO_MIGRATE=1 for a single dev worker). Engines, broker
+# subscriptions and background tasks are set up in lifespan().
+#
+# Only the app itself is built here. The per-worker state (manager, the
+# caches, batcher, limiter and scheduler) is still created at import and read
+# by the routes and gauges as module globals, so every app made in one
+# process shares it and only one of them should be running at a time; an
+# isolated app needs a fresh import of this module.
+def create_app() -> FastAPI:
+    app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.add_api_route("/metrics", metrics.metrics_endpoint, include_in_schema=False)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"], # ONLY * WHEN IN DEV
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Prev-Cursor", "X-Next-Cursor", "Retry-After"],)
+    app.include_router(router)
+    app.mount("/", PrecompressedStaticFiles(directory=str(FRONTEND_DIR), html=True), name="static")
+    metrics.startup.phases["import"] = time.perf_counter() - IMPORT_STARTED
+    return app
+
+app = create_app()
\ No newline at end of file
@@ -0,0 +1,202 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+from threading import Lock
+import bisect
+import time
+
+# A small Prometheus text-format registry so we don't need prometheus_client.
+# Everything is per process; scrape each worker (or put them behind a
+# collector that sums them).
+registry = []
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def inc(self, amount: float = 1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield self.name + _labels(self.label_names, labels), value
+
+
+class Gauge:
+    # Computed at scrape time: fn returns a number, or (label values, number) pairs
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label_names = tuple(labels)
+        registry.append(self)
+
+    def samples(self):
+        value = self.fn()
+        if not self.label_names:
+            yield self.name, value
+            return
+        for labels, v in value:
+            yield self.name + _labels(self.label_names, labels), v
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [[0] * len(self.buckets), 0, 0.0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                counts[0][i] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    def samples(self):
+        for labels, (buckets, count, total) in list(self.values.items()):
+            running = 0
+            for bound, n in zip(self.buckets, buckets):
+                running += n
+                yield self.name + "_bucket" + _labels(self.label_names + ("le",), labels + (bound,)), running
+            yield self.name + "_bucket" + _labels(self.label_names + ("le",), labels + ("+Inf",)), count
+            yield self.name + "_count" + _labels(self.label_names, labels), count
+            yield self.name + "_sum" + _labels(self.label_names, labels), total
+
+
+class StartupTimer:
+    # Seconds this worker spent in each phase of startup, in order
+    def __init__(self):
+        self.phases = {}
+        Gauge("startup_phase_seconds", "Time spent in each phase of this worker's startup.",
+              lambda: [((name,), seconds) for name, seconds in self.phases.items()], labels=("phase",))
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def summary(self) -> str:
+        total = sum(self.phases.values())
+        return f"{total:.3f}s (" + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.phases.items()) + ")"
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, value in metric.samples():
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def metrics_endpoint():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+
+http_request_seconds = Histogram("http_request_duration_seconds", "HTTP request latency by route.",
+                                 labels=("method", "route", "status"))
+http_request_queries = Histogram("http_request_db_queries", "Database queries issued per HTTP request.",
+                                 labels=("route",), buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50))
+db_reads = Counter("db_read_sessions_total", "Read-route sessions by where they were sent.", labels=("target",))
+db_query_seconds = Histogram("db_query_duration_seconds", "Database statement execution time.")
+broadcast_seconds = Histogram("ws_broadcast_duration_seconds", "Time to hand a frame to every local socket in a room.")
+broadcast_recipients = Histogram("ws_broadcast_recipients", "Local sockets a broadcast frame was queued for.",
+                                 buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+ws_rejections = Counter("ws_rejections_total", "Sockets refused at connect by an admission cap.", labels=("reason",))
+ws_evictions = Counter("ws_evictions_total", "Sockets dropped by the server.", labels=("reason",))
+broker_errors = Counter("broker_errors_total", "Broker publish or listen failures.", labels=("op",))
+rate_limited = Counter("rate_limited_total", "Requests refused by a rate limit.", labels=("limit",))
+ingest_retries = Counter("ingest_flush_retries_total", "Batched message writes retried after a failure.")
+ingest_dropped = Counter("ingest_dropped_messages_total", "Acknowledged messages that were never written.",
+                         labels=("reason",))
+hash_seconds = Histogram("password_hash_duration_seconds", "bcrypt hash/verify time.", labels=("op",),
+                         buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1, 2))
+
+job_seconds = Histogram("scheduler_job_duration_seconds", "Scheduled job run time.", labels=("job",),
+                        buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+job_rows = Counter("scheduler_job_rows_total", "Rows touched by scheduled jobs.", labels=("job",))
+job_failures = Counter("scheduler_job_failures_total", "Scheduled job runs that raised.", labels=("job",))
+startup = StartupTimer()
+
+# Query count for the request being handled. The middleware puts a fresh
+# one-item list here for each request; the SQLAlchemy hook bumps it.
+request_queries = ContextVar("request_queries", default=None)
+
+
+class MetricsMiddleware:
+    # Plain ASGI so it neither buffers bodies nor touches WebSockets
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        queries = [0]
+        token = request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_queries.reset(token)
+            route = scope.get("route")
+            route = getattr(route, "path", "unmatched")
+            http_request_seconds.observe(time.perf_counter() - start, scope["method"], route, status[0])
+            http_request_queries.observe(queries[0], route)
+
+
+def instrument_engine(engine):
+    # Works for sync engines and for AsyncEngine.sync_engine
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        db_query_seconds.observe(time.perf_counter() - conn.info["query_start"].pop())
+        queries = request_queries.get()
+        if queries is not None:
+            queries[0] += 1
@@ -0,0 +1,91 @@
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+import asyncio
+import models
+import search
+
+# Schema management, run once per deploy (`python migrate.py`) instead of by
+# every worker at import. create_all only creates missing tables, so columns
+# and indexes added to existing tables since they were created are added here
+# too, and indexes whose columns changed are rebuilt. New columns have to be
+# nullable or have a server_default. Anything beyond that (renames, type
+# changes, dropping columns) is done by hand.
+
+
+def index_changed(index, found) -> bool:
+    # Compares columns and uniqueness; expression indexes are left alone
+    columns = [c.name for c in index.columns]
+    if len(columns) != len(index.expressions) or None in found["column_names"]:
+        return False
+    return columns != found["column_names"] or bool(index.unique) != bool(found["unique"])
+
+
+def _migrate(conn):
+    changes = []
+    inspector = inspect(conn)
+    existing = set(inspector.get_table_names())
+    models.Base.metadata.create_all(conn)
+    for table in models.Base.metadata.sorted_tables:
+        if table.name not in existing:
+            changes.append(f"created table {table.name}")
+            continue
+        columns = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+                changes.append(f"added column {table.name}.{column.name}")
+        indexes = {i["name"]: i for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            found = indexes.get(index.name)
+            if found is None:
+                index.create(conn)
+                changes.append(f"created index {index.name}")
+            elif index_changed(index, found):
+                # Same name, different definition: the model's index was redefined
+                index.drop(conn)
+                index.create(conn)
+                changes.append(f"recreated index {index.name}")
+    if search.create_index(conn):
+        changes.append("created full-text index on message")
+    numbered = backfill_seq(conn)
+    if numbered:
+        changes.append(f"numbered {numbered} messages that had no seq")
+    return changes
+
+
+def backfill_seq(conn, batch: int = 500) -> int:
+    # Messages from before seq existed are numbered per chat by (created_at,
+    # id), after any seq the chat already has, and last_seq follows. Members
+    # of those chats have read up to there: the history predates unread
+    # counts, so it shouldn't all show as unread.
+    chat_ids = conn.exec_driver_sql("SELECT DISTINCT chat_id FROM message WHERE seq IS NULL").scalars().all()
+    numbered = 0
+    for start in range(0, len(chat_ids), batch):
+        ids = ", ".join(str(int(chat_id)) for chat_id in chat_ids[start:start + batch])
+        numbered += conn.exec_driver_sql(f"""
+            UPDATE message SET seq = numbered.seq FROM (
+                SELECT m.id, COALESCE(c.last_seq, 0)
+                       + ROW_NUMBER() OVER (PARTITION BY m.chat_id ORDER BY m.created_at, m.id) AS seq
+                FROM message m JOIN group_chat c ON c.id = m.chat_id
+                WHERE m.seq IS NULL AND m.chat_id IN ({ids})
+            ) AS numbered WHERE message.id = numbered.id""").rowcount
+        conn.exec_driver_sql(f"""
+            UPDATE group_chat SET last_seq = (SELECT MAX(seq) FROM message WHERE message.chat_id = group_chat.id)
+            WHERE id IN ({ids})""")
+        conn.exec_driver_sql(f"""
+            UPDATE gc_member SET last_read_seq = (SELECT last_seq FROM group_chat WHERE group_chat.id = gc_member.chat_id)
+            WHERE chat_id IN ({ids})""")
+    return numbered
+
+
+async def migrate(engine):
+    # Returns a description of each change made; empty when already up to date
+    async with engine.begin() as conn:
+        return await conn.run_sync(_migrate)
+
+
+if __name__ == "__main__":
+    from database import async_engine
+    changes = asyncio.run(migrate(async_engine))
+    print("\n".join(changes) or "Schema is up to date")
@@ -1,28 +1,319 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, PrimaryKeyConstraint, UniqueConstraint
+from sqlalchemy import Boolean, Column, Float, ForeignKey, Integer, String, DateTime, PrimaryKeyConstraint, UniqueConstraint
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
 from sqlalchemy import Index
+from sqlalchemy.dialects import sqlite
 from fastapi import WebSocket
-from collections import defaultdict
+from collections import deque
+from types import MappingProxyType
+from broker import get_broker
+from serialization import Frame, dumps
+from presence import PresenceTracker
+import asyncio
+import heapq
+import logging
+import metrics
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Longest message text, measured JSON-encoded, so a message event always fits
+# in one broker payload (Postgres NOTIFY takes under 8000 bytes)
+MESSAGE_MAX_BYTES = int(os.getenv("MESSAGE_MAX_BYTES", "4000"))
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+# "drop_oldest" discards the oldest queued frame, "disconnect" closes the socket.
+# A client that loses a message this way is sent a resync frame to refetch.
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")
+RESYNC_FRAME = Frame(dumps({"type": "resync"}))
+WS_SLOW_CONSUMER_CODE = 4408
+# Recent sequenced events kept per room for ?since_seq= resumes, and how long an
+# empty room stays subscribed so a quick reconnect still finds them.
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "256"))
+WS_ROOM_LINGER = float(os.getenv("WS_ROOM_LINGER", "30"))
+WS_REPLAY_DB_LIMIT = int(os.getenv("WS_REPLAY_DB_LIMIT", "500"))
+# A socket that sends nothing for WS_PING_INTERVAL gets a ping frame; if it is
+# still silent after another interval it is closed as dead.
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "25"))
+WS_DEAD_PEER_CODE = 4410
+# Admission caps; 0 means no limit. A full worker closes new sockets with 1013
+# (try again later) so clients reconnect, ideally through the load balancer to
+# another worker; per-user and per-room caps close with 4429.
+WS_MAX_SOCKETS = int(os.getenv("WS_MAX_SOCKETS", "10000"))
+WS_MAX_SOCKETS_PER_USER = int(os.getenv("WS_MAX_SOCKETS_PER_USER", "20"))
+WS_MAX_SOCKETS_PER_ROOM = int(os.getenv("WS_MAX_SOCKETS_PER_ROOM", "5000"))
+WS_WORKER_FULL_CODE = 1013
+WS_LIMIT_CODE = 4429
+
+class Connection:
+    # Each socket gets its own bounded queue and writer task so a slow client
+    # only ever delays itself. Nothing is written until start() hands over the
+    # replay backlog. Live frames the client already has (seq <= since_seq, or
+    # sent in the backlog) are skipped so a resume never repeats an event.
+    # Everything else goes out as it arrives, even when concurrent sends
+    # broadcast their seqs out of order.
+    def __init__(self, manager, chat_id: int, ws: WebSocket, account_id: int, binary: bool = False):
+        self.manager = manager
+        self.chat_id = chat_id
+        self.ws = ws
+        self.account_id = account_id
+        self.binary = binary
+        self.queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.backlog = None
+        self.ready = asyncio.Event()
+        self.since_seq = 0
+        self.replayed = set()
+        self.resync = False
+        self.writer = asyncio.create_task(self._write_loop())
+        self.closing = False
+
+    def start(self, backlog=(), since_seq: int = 0):
+        self.backlog = list(backlog)
+        self.since_seq = since_seq
+        self.ready.set()
+
+    def send(self, frame: Frame | str, seq: int | None = None):
+        if self.closing:
+            return
+        try:
+            self.queue.put_nowait((seq, frame))
+        except asyncio.QueueFull:
+            if WS_OVERFLOW_POLICY == "disconnect":
+                metrics.ws_evictions.inc(1, "overflow")
+                self.evict(WS_SLOW_CONSUMER_CODE)
+                return
+            dropped, _ = self.queue.get_nowait()
+            self.queue.put_nowait((seq, frame))
+            if dropped is not None:
+                self.resync = True
+
+    async def _send(self, seq, frame):
+        if isinstance(frame, str):
+            frame = Frame(frame)
+        if self.binary:
+            await asyncio.wait_for(self.ws.send_bytes(frame.binary), WS_SEND_TIMEOUT)
+        else:
+            await asyncio.wait_for(self.ws.send_text(frame.text), WS_SEND_TIMEOUT)
+
+    async def _write_loop(self):
+        await self.ready.wait()
+        try:
+            for seq, frame in self.backlog:
+                await self._send(seq, frame)
+                if seq is not None:
+                    self.replayed.add(seq)
+            self.backlog = None
+            while True:
+                seq, frame = await self.queue.get()
+                if self.resync:
+                    # A message was dropped; the client refetches the history
+                    # and picks up live frames again from here
+                    self.resync = False
+                    await self._send(None, RESYNC_FRAME)
+                if seq is not None and (seq <= self.since_seq or seq in self.replayed):
+                    # Each replayed seq is broadcast live at most once more
+                    self.replayed.discard(seq)
+                    continue
+                await self._send(seq, frame)
+        except asyncio.TimeoutError:
+            metrics.ws_evictions.inc(1, "send_timeout")
+            await self._close(WS_SLOW_CONSUMER_CODE)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            metrics.ws_evictions.inc(1, "send_error")
+            await self.manager.disconnect(self.chat_id, self.ws)
+
+    def evict(self, code: int):
+        if not self.closing:
+            self.closing = True
+            asyncio.create_task(self._close(code))
+
+    async def _close(self, code: int):
+        self.closing = True
+        try:
+            await asyncio.wait_for(self.ws.close(code=code), WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+        await self.manager.disconnect(self.chat_id, self.ws)
+
+    def stop(self):
+        self.closing = True
+        if self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+
+class RoomRegistry:
+    # chat_id -> {ws: Connection}, plus socket counts per account and in total.
+    # A room is dropped as soon as its last socket leaves.
+    EMPTY = MappingProxyType({})
 
-class ConnectionManager:
     def __init__(self):
-        self.rooms = defaultdict(set)
-    async def connect(self, chat_id: int, ws: WebSocket):
-        await ws.accept()
-        self.rooms[chat_id].add(ws)
-    def disconnect(self, chat_id: int, ws: WebSocket):
-        self.rooms[chat_id].discard(ws)
-    async def broadcast(self, chat_id: int, data: dict):
-        dead = []
-        for ws in list(self.rooms[chat_id]):
-            try:
-                await ws.send_json(data)
-            except Exception:
-                dead.append(ws)
-        for ws in dead:
-            self.disconnect(chat_id, ws)
+        self.rooms = {}
+        self.user_sockets = {}
+        self.sockets = 0
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def get(self, chat_id: int):
+        return self.rooms.get(chat_id, self.EMPTY)
+
+    def admit(self, chat_id: int, account_id: int):
+        # The reason a new socket would break a cap, or None
+        if WS_MAX_SOCKETS and self.sockets >= WS_MAX_SOCKETS:
+            return "worker_full"
+        if WS_MAX_SOCKETS_PER_USER and self.user_sockets.get(account_id, 0) >= WS_MAX_SOCKETS_PER_USER:
+            return "user_limit"
+        if WS_MAX_SOCKETS_PER_ROOM and len(self.get(chat_id)) >= WS_MAX_SOCKETS_PER_ROOM:
+            return "room_limit"
+        return None
+
+    def add(self, conn: Connection):
+        self.rooms.setdefault(conn.chat_id, {})[conn.ws] = conn
+        self.user_sockets[conn.account_id] = self.user_sockets.get(conn.account_id, 0) + 1
+        self.sockets += 1
+
+    def remove(self, chat_id: int, ws: WebSocket):
+        room = self.rooms.get(chat_id)
+        conn = room.pop(ws, None) if room is not None else None
+        if conn is None:
+            return None
+        if not room:
+            del self.rooms[chat_id]
+        remaining = self.user_sockets[conn.account_id] - 1
+        if remaining:
+            self.user_sockets[conn.account_id] = remaining
+        else:
+            del self.user_sockets[conn.account_id]
+        self.sockets -= 1
+        return conn
+
+    def largest(self, n: int):
+        return heapq.nlargest(n, self.rooms.items(), key=lambda item: len(item[1]))
+
+    def connections(self):
+        return [conn for room in self.rooms.values() for conn in room.values()]
+
+
+class ConnectionManager:
+    # Sockets live in this process, messages travel through the broker. A worker
+    # only subscribes to the chats it currently holds sockets for, and keeps a
+    # ring buffer of the sequenced events it has seen while subscribed.
+    def __init__(self, broker=None):
+        self.rooms = RoomRegistry()
+        self.broker = broker or get_broker()
+        self.origin = uuid.uuid4().hex
+        self.handlers = {}
+        self.buffers = {}
+        self.lingering = {}
+        self.presence = PresenceTracker(self)
+
+    @staticmethod
+    def channel(chat_id: int):
+        return f"chat_{chat_id}"
+
+    async def connect(self, chat_id: int, ws: WebSocket, user, subprotocol: str | None = None, binary: bool = False):
+        # Returns None after closing the socket when it is over a cap. Sockets
+        # are accepted first so the client sees the close code.
+        rejected = self.rooms.admit(chat_id, user.id)
+        if rejected is not None:
+            metrics.ws_rejections.inc(1, rejected)
+            await ws.accept(subprotocol=subprotocol)
+            await ws.close(code=WS_WORKER_FULL_CODE if rejected == "worker_full" else WS_LIMIT_CODE)
+            return None
+        conn = Connection(self, chat_id, ws, user.id, binary)
+        self.rooms.add(conn)
+        try:
+            await ws.accept(subprotocol=subprotocol)
+        except Exception:
+            self.rooms.remove(chat_id, ws)
+            conn.stop()
+            raise
+        self.presence.join(chat_id, user.id, user.username)
+        linger = self.lingering.pop(chat_id, None)
+        if linger is not None:
+            linger.cancel()
+        if chat_id not in self.handlers:
+            async def handler(payload: str, chat_id=chat_id):
+                origin, seq, frame = payload.split("|", 2)
+                if origin == self.origin:
+                    # Already delivered to this worker's sockets by broadcast()
+                    return
+                if seq == "p":
+                    self.presence.receive(chat_id, frame)
+                    return
+                self.deliver(chat_id, frame, int(seq) if seq else None)
+            self.handlers[chat_id] = handler
+            self.buffers[chat_id] = deque(maxlen=WS_REPLAY_BUFFER)
+            await self.broker.subscribe(self.channel(chat_id), handler)
+        return conn
+
+    async def disconnect(self, chat_id: int, ws: WebSocket):
+        conn = self.rooms.remove(chat_id, ws)
+        if conn is not None:
+            conn.stop()
+            self.presence.leave(chat_id, conn.account_id)
+        if not self.rooms.get(chat_id) and chat_id in self.handlers and chat_id not in self.lingering:
+            self.lingering[chat_id] = asyncio.create_task(self._unsubscribe_later(chat_id))
+
+    async def _unsubscribe_later(self, chat_id: int):
+        await asyncio.sleep(WS_ROOM_LINGER)
+        self.lingering.pop(chat_id, None)
+        if not self.rooms.get(chat_id) and chat_id in self.handlers:
+            self.buffers.pop(chat_id, None)
+            await self.broker.unsubscribe(self.channel(chat_id), self.handlers.pop(chat_id))
+
+    # The frame is encoded once here. This worker's sockets get it directly;
+    # the same string goes through the broker to every other worker, and each
+    # wraps it in one Frame shared by all its sockets, JSON or MessagePack.
+    # The sender's origin and the seq ride in front of the frame so receivers
+    # never have to decode it; "p" in place of the seq marks a presence
+    # snapshot. A failed publish only costs the other workers the frame, and
+    # their clients catch up with ?since_seq= when they next reconnect.
+    async def publish(self, chat_id: int, tag: str, text: str):
+        await self.broker.publish(self.channel(chat_id), f"{self.origin}|{tag}|{text}")
+
+    async def broadcast(self, chat_id: int, data: dict, seq: int | None = None):
+        text = dumps(data)
+        self.deliver(chat_id, text, seq)
+        try:
+            await self.publish(chat_id, "" if seq is None else str(seq), text)
+        except Exception:
+            metrics.broker_errors.inc(1, "publish")
+            logger.exception("Publishing to chat %s failed", chat_id)
+
+    def deliver(self, chat_id: int, text: str, seq: int | None = None):
+        start = time.perf_counter()
+        frame = Frame(text)
+        if seq is not None and chat_id in self.buffers:
+            self.buffers[chat_id].append((seq, frame))
+        conns = list(self.rooms.get(chat_id).values())
+        for conn in conns:
+            conn.send(frame, seq)
+        metrics.broadcast_seconds.observe(time.perf_counter() - start)
+        metrics.broadcast_recipients.observe(len(conns))
+
+    def replay(self, chat_id: int, since_seq: int):
+        # Events after since_seq from memory, or None when the buffer doesn't
+        # hold an unbroken run of them and the caller has to go to the DB.
+        events = sorted((e for e in self.buffers.get(chat_id, ()) if e[0] >= since_seq), key=lambda e: e[0])
+        if not events or events[0][0] > since_seq + 1:
+            return None
+        if [e[0] for e in events] != list(range(events[0][0], events[-1][0] + 1)):
+            return None
+        return [e for e in events if e[0] > since_seq]
+
+    async def close(self):
+        self.presence.stop()
+        for task in self.lingering.values():
+            task.cancel()
+        for conn in self.rooms.connections():
+            conn.stop()
+        await self.broker.close()
 
 class Accounts(Base):
     __tablename__ = 'account'
@@ -32,6 +323,7 @@ class Accounts(Base):
     email = Column(String(100), unique=True, nullable=False)
     password = Column(String, nullable=False)
     created_at = Column(DateTime, default=func.now(), nullable=False)
+    token_version = Column(Integer, default=0, server_default="0", nullable=False)
 
     chats_created = relationship("Chats", 
                                  back_populates="creator", 
@@ -66,6 +358,12 @@ class Chats(Base):
     name = Column(String, nullable=False)
     created_by = Column(Integer, ForeignKey('account.id', ondelete="CASCADE"), nullable=False)
     created_at = Column(DateTime, default=func.now(), nullable=False)
+    last_seq = Column(Integer, default=0, server_default="0", nullable=False)
+    retention_days = Column(Integer, nullable=True)
+    archived_until = Column(DateTime, nullable=True)
+    # When the chat was first seen with no members, for pruning; cleared if
+    # someone joins again
+    emptied_at = Column(DateTime, nullable=True)
 
     __table_args__ = (
         UniqueConstraint('name', 'created_by', name='uq_chat_name_creator'),
@@ -82,12 +380,19 @@ class ChatMembers(Base):
     
     account_id = Column(Integer, ForeignKey('account.id', ondelete="CASCADE"), nullable=False)
     chat_id = Column(Integer, ForeignKey('group_chat.id', ondelete="CASCADE"), nullable=False)
+    last_read_seq = Column(Integer, default=0, server_default="0", nullable=False)
 
     __table_args__ = (PrimaryKeyConstraint("account_id", "chat_id"),)
 
     account = relationship("Accounts", back_populates="memberships")
     chat = relationship("Chats", back_populates="members")
 
+# SQLite's CURRENT_TIMESTAMP has no fractional part; store bound values the same
+# way so keyset comparisons on (created_at, id) compare like with like.
+MessageTimestamp = DateTime().with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite")
+
 class Messages(Base):
     __tablename__ = 'message'
 
@@ -95,8 +400,9 @@ class Messages(Base):
     account_id = Column(Integer, ForeignKey('account.id', ondelete='SET NULL'), index=True, nullable=True)
     chat_id = Column(Integer, ForeignKey('group_chat.id', ondelete="CASCADE"), nullable=False)
     text = Column(String, nullable=False)
-    created_at = Column(DateTime, default=func.now(), nullable=False)
+    created_at = Column(MessageTimestamp, default=func.now(), nullable=False)
     author_username = Column(String(30), nullable=False) 
+    seq = Column(Integer, nullable=True)
 
     author = relationship("Accounts", back_populates="messages", passive_deletes=True)
     chat = relationship("Chats", back_populates="messages")
@@ -118,5 +424,21 @@ class Invites(Base):
     receiver = relationship("Accounts", foreign_keys=[receiver_id], back_populates="received_invites", passive_deletes=True)
     chat = relationship("Chats", back_populates="invites", passive_deletes=True)
 
-Index("ix_message_chat_time", Messages.chat_id, Messages.created_at)
+class RateLimitBuckets(Base):
+    # Shared token buckets, used when RATE_LIMIT_BACKEND=database
+    __tablename__ = 'rate_limit'
+
+    key = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+    allowed = Column(Boolean, nullable=False)
+
+Index("ix_message_chat_time", Messages.chat_id, Messages.created_at, Messages.id)
+Index("ix_message_chat_seq", Messages.chat_id, Messages.seq)
+# Pending invites are the only ones ever looked up, and expired/resolved rows
+# pile up; these stay small and cover create_invite, GET /invites and expiry.
+Index("ix_invite_pending_receiver", Invites.receiver_id, Invites.created_at, Invites.chat_id,
+      postgresql_where=Invites.status == "pending", sqlite_where=Invites.status == "pending")
+Index("ix_invite_pending_created", Invites.created_at,
+      postgresql_where=Invites.status == "pending", sqlite_where=Invites.status == "pending")
 
@@ -0,0 +1,25 @@
+from fastapi import HTTPException
+from sqlalchemy import literal, tuple_
+from datetime import datetime
+import base64
+
+# Cursors are opaque to clients: the urlsafe base64 of the sort key joined
+# with "|", e.g. "created_at|id" for history or "score|id" for search.
+def encode_cursor(*values) -> str:
+    raw = "|".join(v.isoformat() if isinstance(v, datetime) else repr(v) for v in values).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str, types=(datetime, int)):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        parts = raw.split("|")
+        if len(parts) != len(types):
+            raise ValueError(cursor)
+        return tuple(datetime.fromisoformat(p) if t is datetime else t(p) for t, p in zip(types, parts))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+# Bind each cursor value with its column's type so row comparisons like
+# (created_at, id) < (:created_at, :id) serialize values the way they're stored.
+def cursor_row(columns, values):
+    return tuple_(*(literal(v, col.type) for col, v in zip(columns, values)))
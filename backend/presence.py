@@ -0,0 +1,179 @@
+from broker import NOTIFY_MAX_BYTES
+from dotenv import load_dotenv
+from serialization import Frame, dumps, loads
+import asyncio
+import logging
+import metrics
+import os
+import time
+import uuid
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Who is online and typing in each room. Changes are not sent as they
+# happen: a ticker looks at every room each PRESENCE_INTERVAL and sends at
+# most one "presence" frame per room with what changed since the last one,
+# so a burst of keystrokes or reconnects costs one frame per socket.
+#
+# Each worker only sees its own sockets. With several workers, every worker
+# publishes a snapshot of its local users on the room's broker channel when
+# it changes (and every PRESENCE_REFRESH seconds, so the others can expire it
+# if the worker dies) and merges the snapshots it receives into its view.
+# Snapshots of big rooms are split into parts that each fit in one broker
+# payload; receivers keep each part separately.
+PRESENCE_INTERVAL = float(os.getenv("PRESENCE_INTERVAL", "0.25"))
+PRESENCE_REFRESH = float(os.getenv("PRESENCE_REFRESH", "10"))
+PRESENCE_TTL = PRESENCE_REFRESH * 3
+# Room left for the origin and envelope in each snapshot part
+SNAPSHOT_PART_BYTES = NOTIFY_MAX_BYTES - 256
+TYPING_TTL = float(os.getenv("TYPING_TTL", "5"))
+
+
+class RoomPresence:
+    def __init__(self):
+        self.local = {}         # account_id -> [username, open sockets]
+        self.local_typing = {}  # account_id -> (username, expires)
+        self.remote = {}        # (worker origin, part) -> (online, typing, expires)
+        self.shown_online = {}  # what this worker's sockets were last told
+        self.shown_typing = {}
+        self.dirty = False
+        self.published_at = 0.0
+
+
+class PresenceTracker:
+    def __init__(self, manager):
+        self.manager = manager
+        self.origin = uuid.uuid4().hex
+        self.rooms = {}
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def join(self, chat_id: int, account_id: int, username: str):
+        room = self.rooms.setdefault(chat_id, RoomPresence())
+        entry = room.local.setdefault(account_id, [username, 0])
+        entry[1] += 1
+        room.dirty = room.dirty or entry[1] == 1
+
+    def leave(self, chat_id: int, account_id: int):
+        room = self.rooms.get(chat_id)
+        entry = room.local.get(account_id) if room else None
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            del room.local[account_id]
+            room.local_typing.pop(account_id, None)
+            room.dirty = True
+
+    def typing(self, chat_id: int, account_id: int, username: str):
+        room = self.rooms.get(chat_id)
+        if room is None:
+            return
+        # Refreshing someone already shown as typing doesn't need a frame
+        room.dirty = room.dirty or account_id not in room.local_typing
+        room.local_typing[account_id] = (username, time.monotonic() + TYPING_TTL)
+
+    def receive(self, chat_id: int, payload: str):
+        snapshot = loads(payload)
+        if snapshot["origin"] == self.origin:
+            return
+        room = self.rooms.setdefault(chat_id, RoomPresence())
+        origin, part, parts = snapshot["origin"], snapshot["part"], snapshot["parts"]
+        # Parts beyond the new count are left over from a bigger snapshot
+        for key in [key for key in room.remote if key[0] == origin and key[1] >= parts]:
+            del room.remote[key]
+        if not snapshot["online"] and not snapshot["typing"]:
+            room.remote.pop((origin, part), None)
+            return
+        room.remote[(origin, part)] = (dict(snapshot["online"]), dict(snapshot["typing"]),
+                                       time.monotonic() + PRESENCE_TTL)
+
+    def online(self, chat_id: int):
+        room = self.rooms.get(chat_id)
+        if room is None:
+            return {}
+        merged = {account_id: entry[0] for account_id, entry in room.local.items()}
+        for online, _, _ in room.remote.values():
+            merged.update(online)
+        return merged
+
+    def typers(self, chat_id: int):
+        room = self.rooms.get(chat_id)
+        if room is None:
+            return {}
+        merged = {account_id: username for account_id, (username, _) in room.local_typing.items()}
+        for _, typing, _ in room.remote.values():
+            merged.update(typing)
+        return merged
+
+    def snapshot(self, chat_id: int):
+        return {"online": users(self.online(chat_id)), "typing": users(self.typers(chat_id))}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PRESENCE_INTERVAL)
+            now = time.monotonic()
+            for chat_id, room in list(self.rooms.items()):
+                try:
+                    await self._tick(chat_id, room, now)
+                except Exception:
+                    logger.exception("Presence tick failed for chat %s", chat_id)
+
+    async def _tick(self, chat_id: int, room: RoomPresence, now: float):
+        for account_id, (_, expires) in list(room.local_typing.items()):
+            if expires < now:
+                del room.local_typing[account_id]
+                room.dirty = True
+        for key, (_, _, expires) in list(room.remote.items()):
+            if expires < now:
+                del room.remote[key]
+
+        if room.dirty or (room.local and now - room.published_at > PRESENCE_REFRESH):
+            room.dirty = False
+            room.published_at = now
+            # A failed publish costs the other workers one refresh; this
+            # worker's sockets still get their frame below
+            try:
+                await self._publish(chat_id, room)
+            except Exception:
+                metrics.broker_errors.inc(1, "publish")
+                logger.exception("Publishing presence for chat %s failed", chat_id)
+
+        online, typing = self.online(chat_id), self.typers(chat_id)
+        joined = {account_id: username for account_id, username in online.items() if account_id not in room.shown_online}
+        left = [account_id for account_id in room.shown_online if account_id not in online]
+        if joined or left or typing.keys() != room.shown_typing.keys():
+            frame = Frame(dumps({"type": "presence",
+                                 "payload": {"joined": users(joined), "left": left, "typing": users(typing)}}))
+            for conn in list(self.manager.rooms.get(chat_id).values()):
+                conn.send(frame)
+            room.shown_online, room.shown_typing = online, typing
+
+        if not room.local and not room.remote and not room.shown_online:
+            del self.rooms[chat_id]
+
+    async def _publish(self, chat_id: int, room: RoomPresence):
+        entries = [("online", [account_id, entry[0]]) for account_id, entry in room.local.items()]
+        entries += [("typing", [account_id, username]) for account_id, (username, _) in room.local_typing.items()]
+        parts, size = [{"online": [], "typing": []}], 0
+        for key, entry in entries:
+            entry_size = len(dumps(entry).encode()) + 1
+            if size + entry_size > SNAPSHOT_PART_BYTES and size:
+                parts.append({"online": [], "typing": []})
+                size = 0
+            parts[-1][key].append(entry)
+            size += entry_size
+        for i, part in enumerate(parts):
+            await self.manager.publish(chat_id, "p", dumps({"origin": self.origin, "part": i, "parts": len(parts), **part}))
+
+
+def users(accounts: dict):
+    return [{"account_id": account_id, "username": username} for account_id, username in accounts.items()]
@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from fastapi import HTTPException, Request, status
+from sqlalchemy import Float, String, bindparam, text
+from dotenv import load_dotenv
+import math
+import metrics
+import os
+import time
+
+load_dotenv()
+
+# Token buckets: each key holds up to `capacity` tokens and regains them at
+# capacity/period per second; a request spends one (or `cost`). Limits are set per route
+# as RATE_LIMIT_<NAME>="<capacity>/<period seconds>", or "off".
+#
+# RATE_LIMIT_BACKEND=memory keeps buckets in this worker (N workers allow N
+# times the limit). RATE_LIMIT_BACKEND=database keeps them in the rate_limit
+# table so every worker shares them, at the cost of one UPSERT per check.
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_KEYS = int(os.getenv("RATE_LIMIT_KEYS", "100000"))
+
+DEFAULT_LIMITS = {
+    "message": "30/10",        # per account
+    "chat_message": "300/10",  # per chat, across all senders
+    "invite": "20/60",         # per account, one token per invite sent, bulk included
+    "bulk_invite": "5/60",     # per account, one token per bulk request
+    "token": "10/60",          # per client IP
+}
+
+
+class Limit:
+    def __init__(self, name: str, capacity: float, period: float):
+        self.name = name
+        self.capacity = capacity
+        self.rate = capacity / period
+
+
+def parse_limit(name: str, value: str):
+    if value.strip().lower() in ("", "0", "off"):
+        return None
+    capacity, _, period = value.partition("/")
+    return Limit(name, float(capacity), float(period or 1))
+
+
+limits = {name: parse_limit(name, os.getenv(f"RATE_LIMIT_{name.upper()}", default))
+          for name, default in DEFAULT_LIMITS.items()}
+
+
+class MemoryBuckets:
+    # key -> (tokens, updated); least recently used keys fall out first, which
+    # only ever resets a bucket to full.
+    def __init__(self, maxsize: int = RATE_LIMIT_KEYS):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    async def take(self, limit: Limit, key: str, cost: float = 1) -> float:
+        now = time.monotonic()
+        tokens, updated = self.data.get(key, (limit.capacity, now))
+        tokens = min(limit.capacity, tokens + (now - updated) * limit.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / limit.rate
+        self.data[key] = (tokens, now)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+        return wait
+
+
+class DatabaseBuckets:
+    # One INSERT ... ON CONFLICT DO UPDATE per check, so concurrent workers
+    # serialise on the row. Wall-clock time is used since it has to agree
+    # across processes.
+    elapsed = "(CASE WHEN :now > rate_limit.updated_at THEN :now - rate_limit.updated_at ELSE 0 END)"
+    refill = (f"(CASE WHEN rate_limit.tokens + {elapsed} * :rate > :capacity THEN :capacity "
+              f"ELSE rate_limit.tokens + {elapsed} * :rate END)")
+    statement = text(
+        "INSERT INTO rate_limit (key, tokens, updated_at, allowed) VALUES (:key, :capacity - :cost, :now, true) "
+        "ON CONFLICT (key) DO UPDATE SET "
+        f"allowed = {refill} >= :cost, "
+        f"tokens = CASE WHEN {refill} >= :cost THEN {refill} - :cost ELSE {refill} END, "
+        "updated_at = :now "
+        "RETURNING tokens, allowed"
+    ).bindparams(bindparam("key", type_=String), bindparam("now", type_=Float),
+                 bindparam("rate", type_=Float), bindparam("capacity", type_=Float),
+                 bindparam("cost", type_=Float))
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def take(self, limit: Limit, key: str, cost: float = 1) -> float:
+        async with self.engine.begin() as conn:
+            tokens, allowed = (await conn.execute(self.statement, {
+                "key": key, "now": time.time(), "rate": limit.rate, "capacity": limit.capacity, "cost": cost})).one()
+        return 0.0 if allowed else (cost - tokens) / limit.rate
+
+
+class RateLimiter:
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    async def hit(self, name: str, key, cost: float = 1) -> float:
+        # Seconds until `cost` tokens are available, 0 when this call was allowed
+        limit = limits.get(name)
+        if limit is None:
+            return 0.0
+        if cost > limit.capacity:
+            metrics.rate_limited.inc(1, name)
+            return math.inf
+        wait = await self.buckets.take(limit, f"{name}:{key}", cost)
+        if wait:
+            metrics.rate_limited.inc(1, name)
+        return wait
+
+    async def check(self, name: str, key, cost: float = 1):
+        wait = await self.hit(name, key, cost)
+        if wait == math.inf:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                detail=f"At most {limits[name].capacity:g} at a time, send fewer.")
+        if wait:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                detail="Too many requests, slow down.",
+                                headers={"Retry-After": str(math.ceil(wait))})
+
+
+def client_ip(request: Request) -> str:
+    # Run uvicorn with --proxy-headers behind a proxy so this is the real client
+    return request.client.host if request.client else "unknown"
+
+
+def get_limiter(engine):
+    if RATE_LIMIT_BACKEND == "memory":
+        return RateLimiter(MemoryBuckets())
+    if RATE_LIMIT_BACKEND == "database":
+        return RateLimiter(DatabaseBuckets(engine))
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND {RATE_LIMIT_BACKEND!r}, expected 'memory' or 'database'")
@@ -0,0 +1,229 @@
+from sqlalchemy import select, update, delete, exists, text
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from dotenv import load_dotenv
+import archive
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+import metrics
+import models
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Periodic maintenance run from the app's lifespan. Most jobs touch shared
+# tables, so only one worker (the leader) runs them: on Postgres whichever
+# worker holds a session advisory lock, otherwise whichever holds an flock on
+# a file next to the database. Jobs that only clean up per-process state run
+# on every worker.
+SCHEDULER = os.getenv("SCHEDULER", "1") == "1"
+SCHEDULER_TICK = float(os.getenv("SCHEDULER_TICK", "5"))
+SCHEDULER_START_DELAY = float(os.getenv("SCHEDULER_START_DELAY", "30"))
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "1000"))
+INVITE_TTL_DAYS = float(os.getenv("INVITE_TTL_DAYS", "30"))
+EMPTY_CHAT_GRACE_HOURS = float(os.getenv("EMPTY_CHAT_GRACE_HOURS", "24"))
+LEADER_LOCK_KEY = 0x63686174  # any constant shared by all workers
+
+
+class LeaderElection:
+    def __init__(self, engine):
+        self.engine = engine
+        self.conn = None
+        self.fd = None
+
+    async def acquire(self) -> bool:
+        if self.engine.dialect.name == "postgresql":
+            return await self._acquire_advisory()
+        return self._acquire_file()
+
+    async def _acquire_advisory(self) -> bool:
+        # The lock lives as long as this connection's session, so the
+        # connection is held (outside any transaction) while we lead
+        if self.conn is not None:
+            try:
+                await self.conn.execute(text("SELECT 1"))
+                return True
+            except Exception:
+                logger.warning("Lost the scheduler leader connection")
+                await self.conn.invalidate()
+                self.conn = None
+        conn = await self.engine.connect()
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if await conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": LEADER_LOCK_KEY}):
+            self.conn = conn
+            return True
+        await conn.close()
+        return False
+
+    def _acquire_file(self) -> bool:
+        if self.fd is not None:
+            return True
+        if fcntl is None:
+            # No flock (Windows): there is only ever one worker there
+            return True
+        name = hashlib.sha256(str(self.engine.url).encode()).hexdigest()[:16]
+        fd = os.open(Path(tempfile.gettempdir()) / f"chat-scheduler-{name}.lock", os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    async def release(self):
+        if self.conn is not None:
+            try:
+                await self.conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": LEADER_LOCK_KEY})
+                await self.conn.close()
+            except Exception:
+                await self.conn.invalidate()
+            self.conn = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Job:
+    def __init__(self, name: str, interval: float, fn, leader_only: bool):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.leader_only = leader_only
+        self.next_run = time.monotonic() + min(interval, SCHEDULER_START_DELAY)
+
+
+class Scheduler:
+    def __init__(self, engine):
+        self.election = LeaderElection(engine)
+        self.jobs = []
+        self.leader = False
+        self.task = None
+
+    def add(self, name: str, interval: float, fn, leader_only: bool = True):
+        # fn is an async callable returning the number of rows it touched
+        self.jobs.append(Job(name, interval, fn, leader_only))
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.election.release()
+
+    async def _run(self):
+        while True:
+            try:
+                self.leader = await self.election.acquire()
+            except Exception:
+                logger.exception("Scheduler leader election failed")
+                self.leader = False
+            for job in self.jobs:
+                if job.next_run <= time.monotonic() and (self.leader or not job.leader_only):
+                    await self.run_job(job)
+                    job.next_run = time.monotonic() + job.interval
+            await asyncio.sleep(SCHEDULER_TICK)
+
+    async def run_job(self, job: Job):
+        start = time.perf_counter()
+        try:
+            rows = await job.fn() or 0
+            metrics.job_rows.inc(rows, job.name)
+        except Exception:
+            metrics.job_failures.inc(1, job.name)
+            logger.exception("Scheduled job %s failed", job.name)
+        finally:
+            metrics.job_seconds.observe(time.perf_counter() - start, job.name)
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+async def expire_invites(session_factory) -> int:
+    # Pending invites older than INVITE_TTL_DAYS become "expired", a batch per
+    # transaction so no single UPDATE holds locks for long
+    cutoff = utcnow() - timedelta(days=INVITE_TTL_DAYS)
+    expired = 0
+    async with session_factory() as db:
+        while True:
+            ids = (await db.scalars(select(models.Invites.id)
+                   .where(models.Invites.status == "pending", models.Invites.created_at < cutoff)
+                   .limit(SCHEDULER_BATCH_SIZE))).all()
+            if not ids:
+                return expired
+            await db.execute(update(models.Invites).where(models.Invites.id.in_(ids))
+                             .values(status="expired").execution_options(synchronize_session=False))
+            await db.commit()
+            expired += len(ids)
+
+
+async def prune_empty_chats(session_factory) -> int:
+    # Chats nobody belongs to any more, once they have been empty a while.
+    # Members only go when their account is deleted (by cascade, so no route
+    # sees it), so each run stamps emptied_at on chats it finds newly empty
+    # and clears it on ones that have members again; the grace period counts
+    # from that stamp, not from when the chat was created. Their messages and
+    # invites are deleted explicitly because SQLite does not enforce the ON
+    # DELETE CASCADE foreign keys by default, and their archive files too.
+    now = utcnow()
+    cutoff = now - timedelta(hours=EMPTY_CHAT_GRACE_HOURS)
+    pruned = 0
+    has_members = exists().where(models.ChatMembers.chat_id == models.Chats.id)
+    async with session_factory() as db:
+        await db.execute(update(models.Chats).where(~has_members, models.Chats.emptied_at.is_(None))
+                         .values(emptied_at=now).execution_options(synchronize_session=False))
+        await db.execute(update(models.Chats).where(has_members, models.Chats.emptied_at.is_not(None))
+                         .values(emptied_at=None).execution_options(synchronize_session=False))
+        await db.commit()
+        while True:
+            ids = (await db.scalars(select(models.Chats.id)
+                   .where(~has_members, models.Chats.emptied_at < cutoff)
+                   .limit(SCHEDULER_BATCH_SIZE))).all()
+            if not ids:
+                return pruned
+            for table in (models.Messages, models.Invites):
+                await db.execute(delete(table).where(table.chat_id.in_(ids)))
+            await db.execute(delete(models.Chats).where(models.Chats.id.in_(ids)))
+            await db.commit()
+            for chat_id in ids:
+                await asyncio.to_thread(shutil.rmtree, archive.chat_dir(chat_id), ignore_errors=True)
+            pruned += len(ids)
+
+
+async def optimize(engine) -> int:
+    # Keep planner statistics fresh: ANALYZE on Postgres (autovacuum does the
+    # VACUUM part), PRAGMA optimize on SQLite
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if engine.dialect.name == "postgresql":
+            for table in ("message", "invite", "gc_member", "group_chat", "account"):
+                await conn.execute(text(f"ANALYZE {table}"))
+        elif engine.dialect.name == "sqlite":
+            await conn.execute(text("PRAGMA optimize"))
+    return 0
+
+
+async def prune_rate_limits(session_factory, older_than: float = 86400) -> int:
+    # Buckets untouched this long are full again, so the row adds nothing
+    async with session_factory() as db:
+        result = await db.execute(delete(models.RateLimitBuckets)
+                                  .where(models.RateLimitBuckets.updated_at < time.time() - older_than))
+        await db.commit()
+    return result.rowcount or 0
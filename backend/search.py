@@ -0,0 +1,85 @@
+from sqlalchemy import Float, func, literal, literal_column, select, table, column, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+import models
+import pagination
+
+# Postgres searches an expression GIN index over to_tsvector(text). SQLite
+# keeps an external-content FTS5 table in step with message through
+# triggers. Either way the index follows every INSERT, including batched
+# ones, without the routes doing anything.
+FTS_CONFIG = "simple"
+# Inlined rather than bound: a bound parameter is text, not regconfig, and the
+# planner only uses the index when the expression matches it exactly
+FTS_REGCONFIG = literal_column(f"'{FTS_CONFIG}'::regconfig")
+
+POSTGRES_INDEX = f"CREATE INDEX IF NOT EXISTS ix_message_text_fts ON message USING gin (to_tsvector('{FTS_CONFIG}', text))"
+
+SQLITE_FTS = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(text, content='message', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_ai AFTER INSERT ON message BEGIN
+        INSERT INTO message_fts(rowid, text) VALUES (new.id, new.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_ad AFTER DELETE ON message BEGIN
+        INSERT INTO message_fts(message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS message_fts_au AFTER UPDATE OF text ON message BEGIN
+        INSERT INTO message_fts(message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO message_fts(rowid, text) VALUES (new.id, new.text);
+    END""",
+)
+
+
+def create_index(conn) -> bool:
+    # Run by migrate.py on a sync connection. Creates whatever is missing and
+    # indexes the messages already stored; True when anything was created.
+    if conn.dialect.name == "postgresql":
+        # CREATE INDEX indexes existing rows as it builds
+        missing = conn.exec_driver_sql("SELECT to_regclass('ix_message_text_fts')").scalar() is None
+        if missing:
+            conn.exec_driver_sql(POSTGRES_INDEX)
+        return missing
+    if conn.dialect.name == "sqlite":
+        missing = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'message_fts'").scalar() is None
+        for statement in SQLITE_FTS:
+            conn.exec_driver_sql(statement)
+        if missing:
+            conn.exec_driver_sql("INSERT INTO message_fts(message_fts) VALUES ('rebuild')")
+        return missing
+    return False
+
+message_fts = table("message_fts", column("rowid"), column("text"))
+
+
+def fts5_query(q: str):
+    # Quote every term so user input can't use FTS5 operators
+    return " ".join('"' + term.replace('"', '""') + '"' for term in q.split())
+
+
+def search_query(dialect: str, q: str):
+    # Returns (select(Messages, score), score) where a higher score is a better match
+    if dialect == "postgresql":
+        vector = func.to_tsvector(FTS_REGCONFIG, models.Messages.text)
+        query = func.plainto_tsquery(FTS_REGCONFIG, q)
+        score = func.ts_rank(vector, query, type_=Float)
+        return select(models.Messages, score).where(vector.op("@@")(query)), score
+    if dialect == "sqlite":
+        score = (-func.bm25(literal_column("message_fts"), type_=Float)).label("score")
+        return (select(models.Messages, score)
+                .join(message_fts, message_fts.c.rowid == models.Messages.id)
+                .where(literal_column("message_fts").op("MATCH")(fts5_query(q)))), score
+    score = literal(0.0, Float)
+    return select(models.Messages, score).where(models.Messages.text.ilike(f"%{q}%")), score
+
+
+async def search_messages(db: AsyncSession, q: str, chat_ids, limit: int, cursor: str | None = None):
+    # Ranked results keyset-paginated on (score, id). chat_ids is a list or a
+    # subquery of chat ids the caller may read.
+    stmt, score = search_query(db.bind.dialect.name, q)
+    stmt = stmt.where(models.Messages.chat_id.in_(chat_ids))
+    if cursor:
+        after_score, after_id = pagination.decode_cursor(cursor, (float, int))
+        stmt = stmt.where(tuple_(score, models.Messages.id) < pagination.cursor_row(
+            (score, models.Messages.id), (after_score, after_id)))
+    rows = (await db.execute(stmt.order_by(score.desc(), models.Messages.id.desc()).limit(limit))).all()
+    next_cursor = pagination.encode_cursor(rows[-1][1], rows[-1][0].id) if len(rows) == limit else None
+    return [m for m, _ in rows], next_cursor
@@ -0,0 +1,61 @@
+from fastapi.responses import JSONResponse
+import json
+
+# orjson is several times faster than the stdlib encoder; fall back quietly
+# when it is not installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# MessagePack is only needed for WebSocket clients that ask for it
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+if orjson is not None:
+    def dumps_bytes(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+else:
+    def dumps_bytes(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+    def dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    loads = json.loads
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps_bytes(content)
+
+
+def unpackb(data: bytes):
+    if msgpack is None:
+        raise ValueError("MessagePack is not available")
+    return msgpack.unpackb(data)
+
+
+class Frame:
+    # An outbound WebSocket frame. The JSON text is made once by the sender;
+    # the MessagePack form is made from it the first time a binary socket
+    # needs it and then shared by every other binary socket.
+    __slots__ = ("text", "_binary")
+
+    def __init__(self, text: str):
+        self.text = text
+        self._binary = None
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = msgpack.packb(loads(self.text))
+        return self._binary
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from mimetypes import guess_type
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from dotenv import load_dotenv
+import hashlib
+import os
+import re
+
+load_dotenv()
+
+# Serves the built frontend. `npm run build` leaves .br/.gz siblings next to
+# compressible files; those are sent as-is when the client accepts them.
+# Vite's hashed files under assets/ never change, so browsers may keep them
+# for a year; everything else (index.html, public/ files) is revalidated by
+# ETag. Files up to STATIC_CACHE_MAX_FILE are kept in memory, up to
+# STATIC_CACHE_BYTES in total, and get an ETag hashed from their contents.
+STATIC_CACHE_MAX_FILE = int(os.getenv("STATIC_CACHE_MAX_FILE", str(256 * 1024)))
+STATIC_CACHE_BYTES = int(os.getenv("STATIC_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+HASHED_NAME = re.compile(r"-[A-Za-z0-9_-]{8,}\.\w+$")
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def accepted_encodings(header: str):
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.variants = {}
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+
+    def find_variants(self, full_path: str, stat_result):
+        # (encoding, path, stat) for each precompressed sibling, looked up once
+        # per version of the file
+        key = (full_path, stat_result.st_mtime_ns)
+        found = self.variants.get(key)
+        if found is None:
+            found = []
+            for encoding, suffix in ENCODINGS:
+                try:
+                    found.append((encoding, full_path + suffix, os.stat(full_path + suffix)))
+                except OSError:
+                    pass
+            self.variants[key] = found
+        return found
+
+    def load(self, path: str, stat_result):
+        if stat_result.st_size > STATIC_CACHE_MAX_FILE:
+            return None
+        key = (path, stat_result.st_mtime_ns, stat_result.st_size)
+        cached = self.cache.get(key)
+        if cached is None:
+            with open(path, "rb") as f:
+                body = f.read()
+            cached = self.cache[key] = (body, '"' + hashlib.sha256(body).hexdigest()[:32] + '"')
+            self.cached_bytes += len(body)
+            while self.cached_bytes > STATIC_CACHE_BYTES and len(self.cache) > 1:
+                _, (old, _) = self.cache.popitem(last=False)
+                self.cached_bytes -= len(old)
+        self.cache.move_to_end(key)
+        return cached
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        path, encoding = full_path, None
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+        for variant_encoding, variant_path, variant_stat in self.find_variants(full_path, stat_result):
+            if variant_encoding in accepted:
+                path, encoding, stat_result = variant_path, variant_encoding, variant_stat
+                break
+
+        hashed = os.path.basename(os.path.dirname(full_path)) == "assets" and HASHED_NAME.search(full_path)
+        headers = {"Cache-Control": IMMUTABLE if hashed and status_code == 200 else REVALIDATE,
+                   "Vary": "Accept-Encoding"}
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        media_type = guess_type(full_path)[0] or "text/plain"
+
+        cached = self.load(path, stat_result)
+        if cached is None:
+            response = FileResponse(path, status_code=status_code, stat_result=stat_result,
+                                    headers=headers, media_type=media_type)
+        else:
+            body, headers["ETag"] = cached
+            response = Response(body, status_code=status_code, headers=headers, media_type=media_type)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,43 @@
+// Writes .br and .gz next to every compressible file in dist/ so the backend
+// can serve them without compressing on each request. Run after `vite build`.
+import { readdir, readFile, writeFile } from "node:fs/promises";
+import { extname, join } from "node:path";
+import { fileURLToPath } from "node:url";
+import { brotliCompressSync, gzipSync, constants } from "node:zlib";
+
+const DIST = fileURLToPath(new URL("../dist/", import.meta.url));
+const COMPRESSIBLE = new Set([".html", ".js", ".mjs", ".css", ".svg", ".json", ".map", ".txt", ".xml", ".ico", ".wasm"]);
+const MIN_SIZE = 1024;
+
+async function* files(dir) {
+  for (const entry of await readdir(dir, { withFileTypes: true })) {
+    const path = join(dir, entry.name);
+    if (entry.isDirectory()) yield* files(path);
+    else yield path;
+  }
+}
+
+let written = 0;
+for await (const path of files(DIST)) {
+  if (!COMPRESSIBLE.has(extname(path))) continue;
+  const data = await readFile(path);
+  if (data.length < MIN_SIZE) continue;
+
+  const variants = [
+    [".br", brotliCompressSync(data, {
+      params: {
+        [constants.BROTLI_PARAM_QUALITY]: constants.BROTLI_MAX_QUALITY,
+        [constants.BROTLI_PARAM_SIZE_HINT]: data.length,
+      },
+    })],
+    [".gz", gzipSync(data, { level: 9 })],
+  ];
+  for (const [suffix, compressed] of variants) {
+    // Not worth a variant (or the extra Content-Encoding) if it barely shrinks
+    if (compressed.length > data.length * 0.9) continue;
+    await writeFile(path + suffix, compressed);
+    written++;
+  }
+}
+
+console.log(`precompress: wrote ${written} files`);
@@ -1,6 +1,6 @@
 import { useEffect, useState, useRef } from "react";
 import { login, listChats, me, listMessages, sendMessage, listInvites,
-        acceptInvite, declineInvite, sendInvite, newAccount, createChat} from "./api";
+        acceptInvite, declineInvite, sendInvite, sendInvites, newAccount, createChat, revokeTokens} from "./api";
 import "./App.css";
 
 export default function App() {
@@ -11,6 +11,9 @@ export default function App() {
   const [password, setPassword] = useState("");
 
   const messagesListRef = useRef(null);
+  const wsRef = useRef(null);
+  // The socket send waiting for its ack: { client_id, text }
+  const pendingRef = useRef(null);
 
   const [newUsername, setNewUsername] = useState("")
   const [newPassword, setNewPassword] = useState("")
@@ -29,6 +32,9 @@ export default function App() {
   const [draft, setDraft] = useState("");
   const [notedraft, setnoteDraft] = useState("");
   const [error, setError] = useState("");
+  const [online, setOnline] = useState({});
+  const [typing, setTyping] = useState([]);
+  const lastTypingRef = useRef(0);
 
   // Add account to database on signup.
   async function handleSignup(e) {
@@ -96,19 +102,9 @@ export default function App() {
     })();
   }, [token]);
 
-  // Load inital chat messages on selection
+  // Clear messages if no chat is active
   useEffect(() => {
-    if (!token || !activeChatId) {
-      setMessages([]); // Clear messages if no chat is active
-      return;
-    }
-    listMessages(token, activeChatId, 100)
-      .then(ms => {
-        setMessages(ms);
-      })
-      .catch(err => {
-        setError(err.message);
-      });
+    if (!token || !activeChatId) setMessages([]);
   }, [token, activeChatId]);
 
   // Automatically scroll to bottom of chat (newest messages)
@@ -119,30 +115,100 @@ export default function App() {
     }
   }, [messages]);
 
-  // Websocket stuff for grabbing new messages
+  // Websocket stuff for grabbing new messages. The history is loaded first
+  // and the socket connects with the newest seq in it, so the server replays
+  // anything sent in between; on a dropped connection we reconnect with the
+  // last seq we saw and the server replays the gap.
   useEffect(() => {
     if (!token || !activeChatId) return;
 
 
     const WS_BASE = (import.meta.env.VITE_API_BASE || window.location.origin).replace(/^http/, "ws");
+    let ws;
+    let lastSeq = 0;
+    let closed = false;
+    let retry;
+
+    function loadHistory() {
+      return listMessages(token, activeChatId, 100).then(ms => {
+        if (closed) return;
+        for (const m of ms) if (m.seq != null) lastSeq = Math.max(lastSeq, m.seq);
+        setMessages(ms);
+      });
+    }
 
-    const ws = new WebSocket(
-      `${WS_BASE}/gc/${activeChatId}/ws?token=${encodeURIComponent(token)}`
-    );
+    function connect() {
+      ws = new WebSocket(
+        `${WS_BASE}/gc/${activeChatId}/ws?token=${encodeURIComponent(token)}&since_seq=${lastSeq}`
+      );
+      wsRef.current = ws;
+
+      // A send that wasn't acked before the socket dropped goes out again with
+      // the same client_id; the server answers a repeat without reposting it
+      ws.onopen = () => {
+        const pending = pendingRef.current;
+        if (pending) ws.send(JSON.stringify({ type: "send", text: pending.text, client_id: pending.client_id }));
+      };
+
+      ws.onmessage = (evt) => {
+        try {
+          const msg = JSON.parse(evt.data);
+          if (msg?.type === "message" && msg.payload) {
+            if (msg.seq != null) lastSeq = Math.max(lastSeq, msg.seq);
+            setMessages(prev => prev.some(m => m.id === msg.payload.id) ? prev : [...prev, msg.payload]);
+          } else if (msg?.type === "presence") {
+            const p = msg.payload;
+            setOnline(prev => {
+              const next = p.online ? {} : { ...prev };
+              for (const u of p.online || p.joined || []) next[u.account_id] = u.username;
+              for (const id of p.left || []) delete next[id];
+              return next;
+            });
+            setTyping(p.typing);
+          } else if (msg?.type === "ping") {
+            ws.send(JSON.stringify({ type: "pong" }));
+          } else if (msg?.type === "resync") {
+            loadHistory().catch(() => {});
+          } else if (msg?.type === "ack") {
+            if (pendingRef.current?.client_id === msg.client_id) {
+              pendingRef.current = null;
+              setDraft("");
+            }
+            if (msg.payload) setMessages(prev => prev.some(m => m.id === msg.payload.id) ? prev : [...prev, msg.payload]);
+          } else if (msg?.type === "error") {
+            // The draft stays put; sending it again reuses the same client_id
+            setError(msg.retry_after != null
+              ? `Sending too fast, try again in ${msg.retry_after}s.`
+              : msg.detail || "Failed to send message.");
+          }
+        } catch {}
+      };
+
+      ws.onclose = (evt) => {
+        // 4429: too many sockets for this user or room; 1013: server full, back off
+        if (closed || evt.code === 4401 || evt.code === 4403 || evt.code === 4429) return;
+        retry = setTimeout(connect, evt.code === 1013 ? 5000 + Math.random() * 5000 : 1000);
+      };
+    }
 
-    ws.onmessage = (evt) => {
-      try {
-        const msg = JSON.parse(evt.data);
-        if (msg?.type === "message" && msg.payload) {
-          setMessages(prev => [...prev, msg.payload]);
-        }
-      } catch {}
+    loadHistory()
+      .catch(err => setError(err.message))
+      .then(() => { if (!closed) connect(); });
+
+    return () => {
+      closed = true;
+      clearTimeout(retry);
+      wsRef.current = null;
+      pendingRef.current = null;
+      setOnline({});
+      setTyping([]);
+      if (ws) ws.close();
     };
-    return () => ws.close();
   }, [token, activeChatId]);
 
   // On logout, clear all variables associated with user.
   function logout() {
+    if (token) revokeTokens(token).catch(() => {});
     setToken("");
     localStorage.removeItem("token");
     setChats([]);
@@ -347,6 +413,7 @@ export default function App() {
           <div className="chat-main-header">
             <h2>{activeChat?.name || "Select a chat"}</h2>
             {activeChat && <span>#{activeChat.id}</span>}
+            {activeChat && <span>{Object.keys(online).length} online</span>}
           </div>
 
           <div className="messages-list" ref={messagesListRef}>
@@ -368,23 +435,46 @@ export default function App() {
             {!messages.length && <div className="empty-state">No messages yet... say hello!</div>}
           </div>
 
+          {typing.some(u => Number(u.account_id) !== Number(currentUserId)) && (
+            <div className="typing-indicator">
+              {typing.filter(u => Number(u.account_id) !== Number(currentUserId)).map(u => u.username).join(", ")} typing…
+            </div>
+          )}
+
           <form className="composer" onSubmit={async e => {
             e.preventDefault();
             if (!draft.trim()) return;
 
             try {
-              await sendMessage(token, activeChatId, draft);
+              // Send over the open socket when we have one, otherwise POST. A
+              // socket send keeps the draft until its ack arrives, and sending
+              // the same text again is a retry under the same client_id.
+              const ws = wsRef.current;
+              if (ws && ws.readyState === WebSocket.OPEN) {
+                if (pendingRef.current?.text !== draft) {
+                  pendingRef.current = { client_id: crypto.randomUUID(), text: draft };
+                }
+                ws.send(JSON.stringify({ type: "send", ...pendingRef.current }));
+              } else {
+                await sendMessage(token, activeChatId, draft);
+                setDraft("");
+              }
             } catch (err) {
               console.error(err);
-              setDraft(draft);
               setError("Failed to send message.");
             }
-
-            setDraft("");
           }}>
             <input
               value={draft}
-              onChange={e => setDraft(e.target.value)}
+              onChange={e => {
+                setDraft(e.target.value);
+                // The server shows us as typing for a few seconds per frame
+                const ws = wsRef.current;
+                if (ws && ws.readyState === WebSocket.OPEN && Date.now() - lastTypingRef.current > 2000) {
+                  lastTypingRef.current = Date.now();
+                  ws.send(JSON.stringify({ type: "typing" }));
+                }
+              }}
               placeholder={activeChatId ? "Type a message…" : "Select a chat first"}
               disabled={!activeChatId}
             />
@@ -406,6 +496,18 @@ export default function App() {
 
               setIsSendingInvite(true);
               try {
+                const ids = receiverId.split(",").map(s => s.trim()).filter(Boolean).map(Number);
+                if (ids.length > 1) {
+                  const results = await sendInvites(token, ids, Number(activeChatId), notedraft.trim());
+                  const sent = results.filter(r => r.ok);
+                  setInvites(prev => [...sent.map(r => r.invite), ...prev]);
+                  setnoteDraft("");
+                  setReceiverId(results.filter(r => !r.ok).map(r => r.id).join(", "));
+                  if (sent.length) setSuccess(`${sent.length} invite(s) sent.`);
+                  const failed = results.filter(r => !r.ok);
+                  if (failed.length) setError(failed.map(r => `#${r.id}: ${r.detail}`).join(" "));
+                  return;
+                }
                 const created = await sendInvite(
                   token,
                   Number(receiverId),
@@ -423,11 +525,11 @@ export default function App() {
               }
             }}>
               <div className="field">
-                <label>Receiver ID</label>
+                <label>Receiver ID(s)</label>
                 <input
                   value={receiverId}
                   onChange={e => setReceiverId(e.target.value)}
-                  placeholder="e.g. 42"
+                  placeholder="e.g. 42 or 42, 43, 44"
                 />
               </div>
               <div className="field">
@@ -25,6 +25,15 @@ export async function login(username, password) {
     return res.json();
 }   
 
+export async function revokeTokens(token) {
+    const res = await fetch(`${API}/logout`, {
+        method: "POST",
+        headers: authHeaders(token),
+    });
+    if (!res.ok) throw new Error("Failed to log out");
+    return res.json();
+}
+
 export async function me(token) {
     const res = await fetch(`${API}/users/me/`, {
         headers: { Authorization: `Bearer ${token}` },
@@ -99,6 +108,23 @@ export async function sendMessage(token, chatId, text) {
     return res.json();
 }
 
+// One request for many receivers; returns a result per receiver id
+export async function sendInvites(token, receiver_ids, chat_id, text) {
+    const res = await fetch(`${API}/gc/invites/bulk`, {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json",
+            ...authHeaders(token),
+        },
+        body: JSON.stringify({ receiver_ids, chat_id, text }),
+    });
+    if (!res.ok) {
+        const msg = await res.text();
+        throw new Error(`Send failed: ${res.status} ${msg}`);
+    }
+    return res.json();
+}
+
 export async function sendInvite(token, receiver_id, chat_id, text) {
     const res = await fetch(`${API}/gc/invites`, {
         method: "POST",
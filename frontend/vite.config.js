@@ -20,6 +20,8 @@ export default defineConfig({
       "/gc":      { target: "http://127.0.0.1:8000", changeOrigin: true, ws: true },
       "/invites": { target: "http://127.0.0.1:8000", changeOrigin: true, ws: true },
       "/sign_up": { target: "http://127.0.0.1:8000", changeOrigin: true },
+      "/logout":  { target: "http://127.0.0.1:8000", changeOrigin: true },
+      "/messages": { target: "http://127.0.0.1:8000", changeOrigin: true },
     },
 
     // HMR over Cloudflare HTTPS